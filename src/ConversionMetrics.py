@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+    Per-stage timing and memory of a conversion.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys
+import time
+import json
+import resource
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    # Only Python 3.4 and later trace allocations
+    tracemalloc = None
+
+def current_rss():
+    """
+    Return the current RSS of the process in kilobytes, or None where
+    /proc is not available
+    """
+    
+    try:
+        f = open('/proc/self/statm', 'r')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+    except (IOError, IndexError, ValueError):
+        return None
+    
+    return pages * resource.getpagesize() // 1024
+
+def usage():
+    """
+    Return (wall time, CPU time, peak RSS so far, current RSS) of the
+    process, RSS in kilobytes
+    """
+    
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    peak = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes rather than kilobytes
+        peak = peak // 1024
+    
+    return (time.time(), rusage.ru_utime + rusage.ru_stime, peak, current_rss())
+
+class ConversionMetrics(object):
+    """
+    Set as the metrics of a LyxDocument, the eBook documents converted
+    from it share it and record the stages of parsing and saving.
+    
+    CPU time and RSS are those of the whole process, so stages run by
+    concurrent threads include each other's work. Each stage records the
+    RSS when it first starts and last ends, and the sum of its growth,
+    where /proc is available. The peak RSS of a stage is that of the
+    process so far, so it only says how much a stage used if the stage
+    raised it.
+    
+    A streamed document is read as its chapters are rendered, so its
+    parse stage is also counted in the render stages.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = usage()
+        # Stage names in the order first measured
+        self.order = []
+        # stage -> {'calls', 'wall', 'cpu', 'process_peak_rss_kb'[, 'rss_start_kb',
+        # 'rss_end_kb', 'rss_delta_kb'][, 'peak_traced_bytes']}
+        self.stages = {}
+        # name -> size, in items or bytes
+        self.sizes = {}
+    
+    def measure(self, stage, function, *args):
+        """
+        Call function as a stage of the conversion, returning its result.
+        The stage is recorded even if function raises.
+        """
+        
+        wall, cpu, peak, rss = usage()
+        try:
+            return function(*args)
+        finally:
+            self._record(stage, wall, cpu, rss)
+    
+    def _record(self, stage, wall, cpu, rss):
+        end_wall, end_cpu, end_peak, end_rss = usage()
+        
+        self.lock.acquire()
+        try:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'process_peak_rss_kb': 0}
+                if rss is not None:
+                    entry['rss_start_kb'] = rss
+                self.order.append(stage)
+            
+            entry['calls'] += 1
+            entry['wall'] += end_wall - wall
+            entry['cpu'] += end_cpu - cpu
+            entry['process_peak_rss_kb'] = max(entry['process_peak_rss_kb'], end_peak)
+            if rss is not None and end_rss is not None:
+                entry['rss_end_kb'] = end_rss
+                entry['rss_delta_kb'] = entry.get('rss_delta_kb', 0) + end_rss - rss
+            
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                entry['peak_traced_bytes'] = max(entry.get('peak_traced_bytes', 0),
+                                                 tracemalloc.get_traced_memory()[1])
+        finally:
+            self.lock.release()
+        
+        return
+    
+    def add_size(self, name, value):
+        self.lock.acquire()
+        self.sizes[name] = self.sizes.get(name, 0) + value
+        self.lock.release()
+        
+        return
+    
+    def report(self):
+        """
+        Return the stages, sizes and totals as a dictionary ready to be
+        written as JSON
+        """
+        
+        wall, cpu, peak, rss = usage()
+        
+        self.lock.acquire()
+        try:
+            stages = []
+            for stage in self.order:
+                entry = dict(self.stages[stage])
+                entry['stage'] = stage
+                stages.append(entry)
+            
+            report = {
+                'stages': stages,
+                'sizes': dict(self.sizes),
+                'total': {
+                    'wall': wall - self.started[0],
+                    'cpu': cpu - self.started[1],
+                    'peak_rss_kb': peak,
+                    'rss_kb': rss,
+                },
+            }
+        finally:
+            self.lock.release()
+        
+        megabytes = report['sizes'].get('input_bytes', 0) / 1048576.0
+        if megabytes:
+            report['total']['wall_per_mb'] = report['total']['wall'] / megabytes
+        
+        return report
+    
+    def write(self, path):
+        """
+        Write the report as JSON to path, or to standard error for '-', as
+        the conversion progress and log go to standard output
+        """
+        
+        data = json.dumps(self.report(), indent=2, sort_keys=True)
+        if path == '-':
+            sys.stderr.write(data + '\n')
+        else:
+            f = open(path, 'w')
+            f.write(data + '\n')
+            f.close()
+        
+        return
@@ -8,17 +8,19 @@
     it under the terms of the GNU General Public License as published by
     the Free Software Foundation, either version 3 of the License, or
     (at your option) any later version.
-
+    
     This program is distributed in the hope that it will be useful,
     but WITHOUT ANY WARRANTY; without even the implied warranty of
     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
     GNU General Public License for more details.
-
+    
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+import os
+
 class EbookDocument(object):
     
     def __init__(self):
@@ -27,6 +29,9 @@ class EbookDocument(object):
         self.chapters = []
         self.file_name = ''
         self.file_ext = '.ebk'
+        
+        # ConversionMetrics recording the stages, or None
+        self.metrics = None
     
     def set_file(self, name):
         self.file_name = name
@@ -39,6 +44,28 @@ class EbookDocument(object):
     def add_chapter(self, chapter):
         self.chapters.append(chapter)
     
+    def measure(self, stage, function, *args):
+        """
+        Call function as a stage of the conversion, recording it in the
+        metrics if there are any
+        """
+        
+        if self.metrics is None:
+            return function(*args)
+        
+        return self.metrics.measure(stage, function, *args)
+    
+    def record_output(self):
+        """
+        Record the size of the saved file in the metrics
+        """
+        
+        if self.metrics is not None:
+            self.metrics.add_size(self.file_name.rsplit('.', 1)[-1] + '_bytes',
+                                  os.path.getsize(self.file_name))
+        
+        return
+    
     def convert_from(self, source):
         name, self.format = source.file_name.rsplit('.', 2)
         self.set_file(name + self.file_ext)
@@ -47,19 +74,43 @@ class EbookDocument(object):
         self.chapters = source.chapters
         self.title = source.title
         self.author = source.author
+        self.metrics = source.metrics
         
         return
 
 class Chapter(object):
     
+    # Books can have many thousands of these, so no per-instance __dict__
+    __slots__ = ('title', 'paragraphs')
+    
     def __init__(self, title):
         self.title = title
         self.paragraphs = []
     
-    def add_paragraph(self, text):
-        self.paragraphs.append(Paragraph(text))
+    def add_paragraph(self, text, images=None):
+        self.paragraphs.append(Paragraph(text, images))
+    
+    def __getstate__(self):
+        # Older pickle protocols, as used to send chapters to worker
+        # processes, need this for classes with __slots__
+        return (self.title, self.paragraphs)
+    
+    def __setstate__(self, state):
+        self.title, self.paragraphs = state
 
 class Paragraph(object):
     
-    def __init__(self, text):
+    __slots__ = ('text', 'images')
+    
+    def __init__(self, text, images=None):
         self.text = text
+        
+        # (offset in the text, file path) of each graphic, or None
+        self.images = images
+    
+    def __getstate__(self):
+        # A tuple, so that the state of an empty paragraph is not false
+        return (self.text, self.images)
+    
+    def __setstate__(self, state):
+        self.text, self.images = state
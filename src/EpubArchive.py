@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+    A zip archive compressing its entries in parallel threads.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys
+import zlib
+import struct
+import hashlib
+import zipfile
+import collections
+
+# Size of the chunks files are read and copied in
+CHUNK_SIZE = 1048576
+
+# Entries compressed outside ZipFile are written through its internals,
+# as ZipFile.writestr of CPython 2.7 does. This was checked against the
+# zipfile module of CPython 2.7.18. Other versions fall back to writestr,
+# which compresses in the calling thread at zlib's default level and
+# reads stored files whole.
+raw_writes = sys.version_info[:2] == (2, 7) and hasattr(zipfile, '_DD_SIGNATURE') and \
+    hasattr(zipfile.ZipFile, '_writecheck') and hasattr(zipfile.ZipInfo, 'FileHeader')
+
+def compress(data, level):
+    """
+    Return (CRC, raw deflate stream) of data, as zipfile writes them
+    """
+    
+    co = zlib.compressobj(level, zlib.DEFLATED, -15)
+    
+    return (zlib.crc32(data) & 0xffffffff, co.compress(data) + co.flush())
+
+def file_digest(path):
+    """
+    Return (SHA-1 hex digest, CRC, size) of a file, reading it in chunks
+    """
+    
+    h = hashlib.sha1()
+    crc = 0
+    size = 0
+    
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    finally:
+        f.close()
+    
+    return (h.hexdigest(), crc & 0xffffffff, size)
+
+class EpubArchive(object):
+    
+    def __init__(self, file_name, level=zlib.Z_DEFAULT_COMPRESSION, workers=1):
+        """
+        Open a zip archive compressing its entries at level, 0 to store
+        them, over workers threads. zlib releases the GIL while it
+        compresses, so the threads run in parallel.
+        """
+        
+        self.zip = zipfile.ZipFile(file_name, "w", compression=zipfile.ZIP_DEFLATED)
+        self.level = level
+        self.workers = raw_writes and workers or 1
+        self.pool = None
+        
+        # (info, uncompressed size, data or compression result) of the
+        # entries not written yet, in the order they were added
+        self.pending = collections.deque()
+    
+    def add(self, info, data):
+        """
+        Add an entry. Entries are written in the order they are added,
+        whatever order their compression finishes in.
+        """
+        
+        if info.compress_type == zipfile.ZIP_DEFLATED and self.level == 0:
+            info.compress_type = zipfile.ZIP_STORED
+        
+        if not raw_writes:
+            self.zip.writestr(info, data)
+            return
+        
+        if info.compress_type == zipfile.ZIP_STORED or self.workers <= 1:
+            self.pending.append((info, len(data), data))
+        else:
+            if self.pool is None:
+                import multiprocessing.pool
+                self.pool = multiprocessing.pool.ThreadPool(self.workers)
+            self.pending.append((info, len(data), self.pool.apply_async(compress, (data, self.level))))
+        
+        # Bound the entries held in memory while keeping the threads busy
+        self._flush(self.workers * 2)
+        
+        return
+    
+    def _flush(self, keep):
+        """
+        Write the pending entries in order, waiting for their compression
+        until at most keep are left, then only while the next is done
+        """
+        
+        while self.pending:
+            info, size, work = self.pending[0]
+            if type(work) is str:
+                if info.compress_type == zipfile.ZIP_STORED:
+                    crc, compressed = zlib.crc32(work) & 0xffffffff, work
+                else:
+                    crc, compressed = compress(work, self.level)
+            elif len(self.pending) > keep or work.ready():
+                crc, compressed = work.get()
+            else:
+                break
+            
+            self._write(info, size, crc, compressed)
+            self.pending.popleft()
+        
+        return
+    
+    def add_file(self, info, path, crc, size):
+        """
+        Add an entry stored from a file, copying it in chunks rather than
+        reading it whole. crc and size are those file_digest returned.
+        """
+        
+        # Entries are written in order, so the pending ones go first
+        self._flush(0)
+        
+        info.compress_type = zipfile.ZIP_STORED
+        
+        f = open(path, 'rb')
+        try:
+            if not raw_writes:
+                self.zip.writestr(info, f.read())
+                return
+            
+            zip64 = self._write_header(info, size, crc, size)
+            
+            left = size
+            while left:
+                chunk = f.read(min(left, CHUNK_SIZE))
+                if not chunk:
+                    raise IOError("File changed while being archived: " + path)
+                self.zip.fp.write(chunk)
+                left -= len(chunk)
+            
+            self._end_entry(info, zip64)
+        finally:
+            f.close()
+        
+        return
+    
+    def _write_header(self, info, size, crc, compress_size):
+        """
+        Append the header of an entry, as ZipFile.writestr would, and
+        return whether it needs the ZIP64 extensions
+        """
+        
+        zip = self.zip
+        if not zip.fp:
+            raise RuntimeError("Attempt to write to ZIP archive that was already closed")
+        
+        info.file_size = size
+        info.compress_size = compress_size
+        info.CRC = crc
+        info.header_offset = zip.fp.tell()
+        zip._writecheck(info)
+        zip._didModify = True
+        
+        zip64 = size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT
+        if zip64 and not zip._allowZip64:
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+        zip.fp.write(info.FileHeader(zip64))
+        
+        return zip64
+    
+    def _end_entry(self, info, zip64):
+        """
+        Finish an entry whose data has been appended, as ZipFile.writestr
+        would
+        """
+        
+        zip = self.zip
+        
+        if info.flag_bits & 0x08:
+            # CRC and sizes after the data
+            zip.fp.write(struct.pack(zip64 and '<LLQQ' or '<LLLL', zipfile._DD_SIGNATURE,
+                                     info.CRC, info.compress_size, info.file_size))
+        zip.fp.flush()
+        zip.filelist.append(info)
+        zip.NameToInfo[info.filename] = info
+        
+        return
+    
+    def _write(self, info, size, crc, compressed):
+        """
+        Append an entry whose data is already compressed
+        """
+        
+        zip64 = self._write_header(info, size, crc, len(compressed))
+        self.zip.fp.write(compressed)
+        self._end_entry(info, zip64)
+        
+        return
+    
+    def close(self):
+        """
+        Write the remaining entries and the central directory
+        """
+        
+        try:
+            self._flush(0)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+            self.zip.close()
+        
+        return
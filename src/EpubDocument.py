@@ -8,29 +8,246 @@
     it under the terms of the GNU General Public License as published by
     the Free Software Foundation, either version 3 of the License, or
     (at your option) any later version.
-
+    
     This program is distributed in the hope that it will be useful,
     but WITHOUT ANY WARRANTY; without even the implied warranty of
     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
     GNU General Public License for more details.
-
+    
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
 import os
+import re
+import shutil
 import logging
-import random
+import hashlib
+import zlib
 import zipfile
-from xml.dom.minidom import parse, parseString
+import threading
+import collections
+from xml.dom.minidom import parseString
 
-from EbookDocument import EbookDocument
-from LyxDocument import LyxDocument
+from EbookDocument import EbookDocument, Chapter
+from TemplateCache import templates
+from EpubArchive import EpubArchive, file_digest
 
-logging.config.fileConfig("logging.conf")
 logger = logging.getLogger('lyx2ebook')
 
+# Date of every archive entry, the earliest a zip file holds, so the
+# same document always gives the same ePub file
+entry_date = (1980, 1, 1, 0, 0, 0)
+
+# Media type of the graphics an ePub 2 reader is required to show
+media_types = {
+    '.gif': 'image/gif',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.png': 'image/png',
+    '.svg': 'image/svg+xml',
+}
+
+def escape(text):
+    """
+    Escape text for XHTML content as minidom does
+    """
+    
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+def chapter_digest(chapter, num, template, images=None):
+    """
+    Return a hash of everything the rendered XHTML of a chapter depends on
+    """
+    
+    h = hashlib.sha1('%d\0%s\0' % (num, template))
+    if chapter.title is None:
+        h.update('\1')
+    else:
+        h.update(chapter.title.encode('utf-8'))
+    for paragraph in chapter.paragraphs:
+        h.update('\0')
+        h.update(paragraph.text.encode('utf-8'))
+        if paragraph.images:
+            for offset, path in paragraph.images:
+                h.update('\1%d\0%s' % (offset, images is not None and images.get(path) or ''))
+    
+    return h.hexdigest()
+
+def split_chapter_template(data):
+    """
+    Return the chapter template serialized before and after the content
+    of its body div
+    """
+    
+    doc = parseString(data)
+    
+    marker = '@@CHAPTER@@'
+    doc.getElementsByTagName('div')[0].appendChild(doc.createTextNode(marker))
+    
+    prefix, suffix = doc.toxml('utf-8').split(marker)
+    
+    return (prefix, suffix)
+
+# Marks the places values go in a serialized template
+slot_pattern = re.compile('@@(\\d+)@@')
+
+# Manifest, spine and navigation entries, attributes in minidom's order
+item_format = '<item href="%s" id="%s" media-type="%s"/>'
+itemref_format = '<itemref idref="%s" linear="yes"/>'
+nav_point_format = ('<navPoint class="chapter" id="%s" playOrder="%s"><navLabel><text>Chapter %s</text>' +
+                    '</navLabel><content src="chapter%s.xhtml"/></navPoint>')
+
+def split_template(doc):
+    """
+    Serialize a template DOM document holding @@N@@ markers where values
+    go, and return (the pieces between the markers, their numbers)
+    """
+    
+    parts = slot_pattern.split(doc.toxml('utf-8'))
+    
+    return (parts[0::2], [int(number) for number in parts[1::2]])
+
+def fill_template(template, values):
+    """
+    Return a template split by split_template with the values put in
+    place of its markers. None leaves an element empty as minidom writes
+    it, when the marker is all it holds.
+    """
+    
+    pieces, slots = template
+    
+    out = [pieces[0]]
+    for counter, slot in enumerate(slots):
+        after = pieces[counter + 1]
+        if values[slot] is None:
+            out[-1] = out[-1][:-1] + '/>'
+            after = after[after.index('>') + 1:]
+        else:
+            out.append(values[slot])
+        out.append(after)
+    
+    return ''.join(out)
+
+def split_package_template(data):
+    """
+    Return the OPF template split around the identifier, title, author,
+    manifest and spine
+    """
+    
+    doc = parseString(data)
+    
+    doc.getElementsByTagName('dc:identifier')[0].appendChild(doc.createTextNode('@@0@@'))
+    doc.getElementsByTagName('dc:title')[0].appendChild(doc.createTextNode('@@1@@'))
+    creator = doc.getElementsByTagName('dc:creator')[0]
+    creator.setAttribute('opf:file-as', '@@2@@')
+    creator.appendChild(doc.createTextNode('@@2@@'))
+    doc.getElementsByTagName('manifest')[0].appendChild(doc.createTextNode('@@3@@'))
+    doc.getElementsByTagName('spine')[0].appendChild(doc.createTextNode('@@4@@'))
+    
+    return split_template(doc)
+
+def split_navigation_template(data):
+    """
+    Return the NCX template split around the identifier, title, author
+    and navigation map
+    """
+    
+    doc = parseString(data)
+    
+    for m in doc.getElementsByTagName('meta'):
+        if m.getAttribute('name') == 'dtb:uid':
+            m.setAttribute('content', '@@0@@')
+    for name, slot in [('docTitle', '@@1@@'), ('docAuthor', '@@2@@')]:
+        text = doc.createElement('text')
+        text.appendChild(doc.createTextNode(slot))
+        doc.getElementsByTagName(name)[0].appendChild(text)
+    doc.getElementsByTagName('navMap')[0].appendChild(doc.createTextNode('@@3@@'))
+    
+    return split_template(doc)
+
+def render_paragraph(paragraph, images):
+    """
+    Return the escaped text of a paragraph with its graphics, images
+    mapping their paths to their names in the archive
+    """
+    
+    if not paragraph.images:
+        return escape(paragraph.text)
+    
+    pieces = []
+    start = 0
+    for offset, path in paragraph.images:
+        pieces.append(escape(paragraph.text[start:offset]))
+        if images.get(path) is not None:
+            pieces.append(u'<img alt="" src="' + escape(images[path]) + u'"/>')
+        start = offset
+    pieces.append(escape(paragraph.text[start:]))
+    
+    return u''.join(pieces)
+
+def render_chapter(job):
+    """
+    Render a chapter to XHTML from the chapter template.
+    
+    It takes a single (template folder, chapter, number, images) tuple so
+    that it can be mapped over a pool of workers. images maps the paths of
+    the chapter's graphics to their names in the archive, or is None.
+    
+    A chapter without a title continues the previous one, so it is
+    rendered without the chapter header.
+    """
+    
+    template_folder, chapter, num, images = job
+    
+    prefix, suffix = templates.get(template_folder + '/OPS/chapter.xhtml', split_chapter_template)
+    
+    header = u''
+    if chapter.title is not None:
+        header = (u'<div class="chapter"><h2><span class="chapterHeader"><span class="translation">' +
+                  u'Chapter</span> <span class="count">' + str(num) + u'</span><br/><span class="chapterTitle">' +
+                  escape(chapter.title) + u'</span></span></h2><br/></div>')
+    
+    # Escape all the paragraphs in one pass, then split them into elements
+    if chapter.paragraphs:
+        if images:
+            text = u'\0'.join([render_paragraph(paragraph, images) for paragraph in chapter.paragraphs])
+        else:
+            text = escape(u'\0'.join([paragraph.text for paragraph in chapter.paragraphs]))
+        content = u'<div><p>' + text.replace(u'\0', u'</p><p>') + u'</p></div>'
+    else:
+        content = u'<div/>'
+    
+    return ''.join([prefix, header.encode('utf-8'), content.encode('utf-8'), suffix])
+
+def render_cached_chapter(job):
+    """
+    Render a (template folder, chapter, number, images, cache folder,
+    template digest) job, reusing the XHTML cached for an unchanged chapter.
+    
+    Return (XHTML, cache file name, whether it was rendered).
+    """
+    
+    file_name = chapter_digest(job[1], job[2], job[5], job[3]) + '.xhtml'
+    path = os.path.join(job[4], file_name)
+    
+    if os.access(path, os.F_OK):
+        f = open(path, 'rb')
+        xhtml = f.read()
+        f.close()
+        return (xhtml, file_name, False)
+    
+    xhtml = render_chapter(job[:4])
+    f = open(path, 'wb')
+    f.write(xhtml)
+    f.close()
+    
+    return (xhtml, file_name, True)
+
 class EpubDocument(EbookDocument):
     
     def __init__(self):
@@ -38,13 +255,51 @@ class EpubDocument(EbookDocument):
         
         self.file_ext = '.epub'
         
-        self._dc = 'http://purl.org/dc/elements/1.1/'
-        self._opf = 'http://www.idpf.org/2007/opf'
-        
-        self.uid = 'Book_%05d' % random.randint(1, 99999)
+        # Identifier of the book, derived from its content when None so
+        # converting the same document gives the same ePub
+        self.uid = None
+        self.identifier = None
+        self._content = None
         
         self.zip = None
         self.template_folder = "template"
+        
+        # Also write the parts to an exploded folder, for debugging
+        self.keep_folder = False
+        
+        # Number of workers rendering chapters, and whether they are
+        # 'process' or 'thread' workers
+        self.chapter_workers = 1
+        self.chapter_pool = 'process'
+        
+        # Only render the chapters changed since the last save, reusing
+        # the XHTML kept in the cache folder for the others
+        self.incremental = False
+        
+        # zlib compression level of the archive entries, 0 to store them,
+        # and number of threads compressing them
+        self.compress_level = zlib.Z_DEFAULT_COMPRESSION
+        self.compress_workers = 1
+        
+        # Split a chapter into several files once a part reaches this
+        # many bytes of text or this many paragraphs, 0 not to
+        self.split_bytes = 256 * 1024
+        self.split_paragraphs = 0
+        
+        # Names of the chapter files written by save in reading order,
+        # '3' and then '3-2', '3-3'... for the parts of a split chapter,
+        # for the manifest, and the numbers of the chapters for the
+        # navigation
+        self.spine = []
+        self.toc = []
+        self._parts = collections.deque()
+        
+        # (name, media type) of the graphics written by save, each file
+        # content stored once, and the (name, CRC, size) of each graphics
+        # path
+        self.images = []
+        self._image_names = {}
+        self._stored_images = set()
     
     def set_file(self, name):
         super(EpubDocument, self).set_file(name);
@@ -52,11 +307,7 @@ class EpubDocument(EbookDocument):
         self.name, self.format = self.file_name.rsplit('.', 2)
         
         self.base_folder = self.name
-        
-        return
-    
-    def convert_from(self, source):
-        super(EpubDocument, self).convert_from(source)
+        self.cache_folder = self.name + '.cache'
         
         return
     
@@ -64,24 +315,61 @@ class EpubDocument(EbookDocument):
         
         logging.info("Converting to ePub...")
         
-        self._create_folder()
+        if self.keep_folder:
+            self._create_folder()
+        
+        # Each part is written straight into the archive
+        self.zip = EpubArchive(self.file_name, self.compress_level, self.compress_workers)
+        
+        self.measure('zip', self._write_mimetype)
+        
+        self.measure('zip', self._write_container)
         
-        self._write_mimetype()
+        self.measure('zip', self._write_css)
+        
+        self._content = hashlib.sha1()
+        self._content.update(self.title.encode('utf-8') + '\0' + self.author.encode('utf-8'))
+        
+        self.images = []
+        self._image_names = {}
+        self._stored_images = set()
+        
+        self.measure('xhtml', self._write_chapters)
+        
+        self.identifier = self.uid
+        if self.identifier is None:
+            self.identifier = 'Book_' + self._content.hexdigest()[:20]
+        
+        self.measure('opf', self._write_metadata)
+        
+        self.measure('ncx', self._write_navigation)
+        
+        self.measure('zip', self.zip.close)
+        self.zip = None
         
-        self._write_container()
+        self.record_output()
         
-        self._write_css()
+        logger.debug("Templates: %d cache hits, %d loads" % (templates.hits, templates.loads))
         
-        self._write_chapters()
+        return
+    
+    def _write_file(self, path, data, compress_type=zipfile.ZIP_DEFLATED):
+        """
+        Add a part to the archive, and to the exploded folder if kept
+        """
         
-        self._write_metadata()
+        if type(data) is unicode:
+            data = data.encode('utf-8')
         
-        self._write_navigation()
+        info = zipfile.ZipInfo(path, entry_date)
+        info.compress_type = compress_type
+        info.external_attr = 0644 << 16L
+        self.zip.add(info, data)
         
-        # Write a new zip file from the created folder
-        if os.access(self.file_name, os.F_OK):
-            os.remove(self.file_name)
-        self.zipepub(self.base_folder, self.file_name)
+        if self.keep_folder:
+            f = open(self.base_folder + '/' + path, 'wb')
+            f.write(data)
+            f.close()
         
         return
     
@@ -105,174 +393,327 @@ class EpubDocument(EbookDocument):
         if not os.access(self.base_folder + '/OPS/css', os.F_OK):
             os.mkdir(self.base_folder + '/OPS/css')
         
+        if not os.access(self.base_folder + '/OPS/images', os.F_OK):
+            os.mkdir(self.base_folder + '/OPS/images')
+        
         #self.zip.write(self.css_folder)
         
         return
     
+    def _render_chapters(self, render, jobs):
+        """
+        Call render on each job, yielding the results in the order of the
+        jobs. Only a few jobs are taken from the iterable at a time, so
+        chapters are read as they are rendered.
+        """
+        
+        if self.chapter_workers <= 1:
+            for job in jobs:
+                yield render(job)
+            
+            return
+        
+        # Only loaded when the chapters are rendered in parallel
+        import multiprocessing.pool
+        
+        if self.chapter_pool == 'thread':
+            pool = multiprocessing.pool.ThreadPool(self.chapter_workers)
+        else:
+            pool = multiprocessing.Pool(self.chapter_workers)
+        
+        # imap takes the jobs in a thread of its own as fast as it can, so
+        # it is only given one when a result has been yielded, keeping
+        # every worker busy with a bounded number of chapters
+        slots = threading.Semaphore(self.chapter_workers * 2)
+        stopped = []
+        
+        def bounded(jobs):
+            for job in jobs:
+                slots.acquire()
+                if stopped:
+                    return
+                yield job
+        
+        try:
+            for result in pool.imap(render, bounded(jobs)):
+                slots.release()
+                yield result
+            pool.close()
+        except:
+            # Unblock the thread taking the jobs, which terminate joins
+            stopped.append(True)
+            slots.release()
+            pool.terminate()
+            raise
+        pool.join()
+        
+        return
+    
     def _write_chapters(self):
         logging.info("Writing chapters...")
         
-        for counter, chapter in enumerate(self.chapters):
-            self._write_chapter(chapter, counter + 1)
+        # Each chapter is rendered and written as it is read, only the
+        # names of its files are kept for the manifest and navigation
+        self.spine = []
+        self.toc = []
+        self._parts.clear()
+        
+        jobs = self._chapter_jobs()
+        
+        if self.incremental:
+            self._write_chapters_incremental(jobs)
+            return
+        
+        for xhtml in self._render_chapters(render_chapter, jobs):
+            self._write_chapter(xhtml)
         
         return
     
-    def _write_css(self):
-        logging.info("Writing CSS...");
+    def _write_chapters_incremental(self, jobs):
+        
+        if not os.access(self.cache_folder, os.F_OK):
+            os.mkdir(self.cache_folder)
         
-        fi = open(self.template_folder + '/OPS/css/style.css', 'r')
-        fo = open(self.base_folder + '/OPS/css/style.css', 'w')
+        template = templates.get(self.template_folder + '/OPS/chapter.xhtml', digest)
+        jobs = (job + (self.cache_folder, template) for job in jobs)
         
-        fo.write(fi.read())
+        used = set()
+        rendered = 0
+        for xhtml, file_name, fresh in self._render_chapters(render_cached_chapter, jobs):
+            used.add(file_name)
+            if fresh:
+                rendered += 1
+            self._write_chapter(xhtml)
         
-        fi.close()
-        fo.close()
+        logger.info("Rendered %d of %d chapter files" % (rendered, len(self.spine)))
+        
+        # Drop the cached chapters the book no longer uses
+        for file_name in os.listdir(self.cache_folder):
+            if file_name not in used:
+                os.remove(os.path.join(self.cache_folder, file_name))
         
         return
     
-    def _write_container(self):
-        logging.info("Writing Container...")
-        
-        fi = open(self.template_folder + '/META-INF/container.xml', 'r')
-        fo = open(self.base_folder + '/META-INF/container.xml', 'w')
+    def _chapter_jobs(self):
+        """
+        Yield the rendering job of each part of each chapter, queueing the
+        name of its file and its graphics for _write_chapter.
         
-        fo.write(fi.read())
+        The jobs are taken in a thread of their own when the chapters are
+        rendered in parallel, so the graphics are only read here and the
+        archive is written by _write_chapter alone.
+        """
         
-        fi.close()
-        fo.close()
+        for counter, chapter in enumerate(self.chapters):
+            num = counter + 1
+            self.toc.append(str(num))
+            
+            for part, chapter_part in enumerate(self._split_chapter(chapter)):
+                if part == 0:
+                    name = str(num)
+                else:
+                    name = '%d-%d' % (num, part + 1)
+                
+                images, files = self._read_images(chapter_part)
+                self._parts.append((name, files))
+                
+                yield (self.template_folder, chapter_part, num, images)
         
         return
     
-    def _write_mimetype(self):
-        logging.info("Writing MIME Type...")
+    def _split_chapter(self, chapter):
+        """
+        Return the parts of a chapter, split at paragraph boundaries once
+        a part reaches split_bytes of text or split_paragraphs paragraphs.
+        The parts after the first have no title.
+        """
+        
+        if not self.split_bytes and not self.split_paragraphs:
+            return [chapter]
+        
+        groups = [[]]
+        size = 0
+        for paragraph in chapter.paragraphs:
+            length = len(paragraph.text.encode('utf-8'))
+            if groups[-1] and ((self.split_bytes and size + length > self.split_bytes) or
+                               (self.split_paragraphs and len(groups[-1]) >= self.split_paragraphs)):
+                groups.append([])
+                size = 0
+            groups[-1].append(paragraph)
+            size += length
+        
+        if len(groups) == 1:
+            return [chapter]
+        
+        parts = []
+        for paragraphs in groups:
+            part = Chapter(None)
+            part.paragraphs = paragraphs
+            parts.append(part)
+        parts[0].title = chapter.title
+        
+        return parts
+    
+    def _read_images(self, chapter):
+        """
+        Return the names of the graphics of a chapter in the archive by
+        path, or None if the chapter has none, and the (path, name, CRC,
+        size) of each graphics file to store
+        """
+        
+        images = None
+        files = []
+        for paragraph in chapter.paragraphs:
+            for offset, path in paragraph.images or []:
+                if images is None:
+                    images = {}
+                name, crc, size = self._read_image(path)
+                images[path] = name
+                if name is not None:
+                    files.append((path, name, crc, size))
+        
+        return (images, files)
+    
+    def _read_image(self, path):
+        """
+        Return the (name relative to the chapters, CRC, size) of a
+        graphics file, named after its content, or (None, None, None) if
+        it cannot be added
+        """
+        
+        if path in self._image_names:
+            return self._image_names[path]
+        
+        entry = (None, None, None)
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in media_types:
+            logger.warning("Unsupported graphics format: " + path)
+        elif not os.access(path, os.R_OK):
+            logger.warning("Graphics file not found: " + path)
+        else:
+            sha1, crc, size = file_digest(path)
+            entry = ('images/' + sha1 + extension, crc, size)
+        
+        self._image_names[path] = entry
+        
+        return entry
+    
+    def _write_image(self, path, name, crc, size):
+        """
+        Add a graphics file to the archive, unless a file with the same
+        content already is
+        """
         
-        f = open(self.base_folder + '/mimetype', 'w')
-        mime = "application/epub+zip"
-        f.write(mime)
-        f.close()
+        if name in self._stored_images:
+            return
+        
+        logger.debug("Adding graphics: " + path)
+        
+        # Compressed image formats gain nothing from deflate
+        info = zipfile.ZipInfo('OPS/' + name, entry_date)
+        info.external_attr = 0644 << 16L
+        self.zip.add_file(info, path, crc, size)
+        self.images.append((name, media_types[os.path.splitext(name)[1]]))
+        self._stored_images.add(name)
+        
+        if self.keep_folder:
+            shutil.copyfile(path, self.base_folder + '/OPS/' + name)
         
         return
     
-    def _write_chapter(self, chapter, num):
-        
-        f = open(self.base_folder + '/OPS/chapter' + str(num) + '.xhtml', 'w')
-        doc = parse(self.template_folder + '/OPS/chapter.xhtml')
+    def _write_chapter(self, xhtml):
+        name, files = self._parts.popleft()
         
-        e = doc.getElementsByTagName('div')[0]
+        # The graphics of each part are written just before it
+        for path, image, crc, size in files:
+            self._write_image(path, image, crc, size)
         
-        xml = parseString('<div class="chapter"><h2><span class="chapterHeader"><span class="translation">' +
-                          'Chapter</span> <span class="count">' + str(num) + '</span><br /><span class="chapterTitle">' +
-                          chapter.title + '</span></span></h2><br /></div>')
-        header = doc.importNode(xml.firstChild, True)
-        e.appendChild(header)
+        self._write_file('OPS/chapter' + name + '.xhtml', xhtml)
+        self.spine.append(name)
         
-        div = doc.createElement('div')
-        e.appendChild(div)
+        self._content.update('\0')
+        self._content.update(xhtml)
         
-        for paragraph in chapter.paragraphs:
-            p = doc.createElement('p')
-            p.appendChild(doc.createTextNode(paragraph.text))
-            div.appendChild(p)
+        return
+    
+    def _write_css(self):
+        logging.info("Writing CSS...");
         
-        doc.writexml(f, '', '', '', 'utf-8')
-        f.close()
+        self._write_file('OPS/css/style.css',
+                         templates.get(self.template_folder + '/OPS/css/style.css'))
         
         return
     
-    def _write_metadata(self):
-        logging.info("Writing metadata file...")
+    def _write_container(self):
+        logging.info("Writing Container...")
         
-        f = open(self.base_folder + '/OPS/book.opf', 'w')
-        doc = parse(self.template_folder + '/OPS/book.opf')
+        self._write_file('META-INF/container.xml',
+                         templates.get(self.template_folder + '/META-INF/container.xml'))
         
-        identifier = doc.getElementsByTagNameNS(self._dc, 'identifier')[0]
-        identifier.appendChild(doc.createTextNode(self.uid))
+        return
+    
+    def _write_mimetype(self):
+        logging.info("Writing MIME Type...")
         
-        title = doc.getElementsByTagNameNS(self._dc, 'title')[0]
-        title.appendChild(doc.createTextNode(self.title))
+        # mimetype must be the first entry and must not be compressed
+        mime = "application/epub+zip"
+        self._write_file('mimetype', mime, zipfile.ZIP_STORED)
         
-        creator = doc.getElementsByTagNameNS(self._dc, 'creator')[0]
-        creator.setAttributeNS(self._opf, 'opf:file-as', self.author)
-        creator.appendChild(doc.createTextNode(self.author))
+        return
+    
+    def _write_metadata(self):
+        logging.info("Writing metadata file...")
         
-        manifest = doc.getElementsByTagName('manifest')[0]
-        spine = doc.getElementsByTagName('spine')[0]
-        for counter, chapter in enumerate(self.chapters):
-            ch_num = str(counter + 1)
-            
-            item = doc.createElement('item')
-            item.setAttribute('id', 'chapter' + ch_num)
-            item.setAttribute('href', 'chapter' + ch_num + '.xhtml')
-            item.setAttribute('media-type', 'application/xhtml+xml')
-            manifest.appendChild(item)
-        
-            itemref = doc.createElement('itemref')
-            itemref.setAttribute('idref', 'chapter' + ch_num)
-            itemref.setAttribute('linear', 'yes')
-            spine.appendChild(itemref)
-        
-        item = doc.createElement('item')
-        item.setAttribute('id', 'main-style')
-        item.setAttribute('href', 'css/style.css')
-        item.setAttribute('media-type', 'text/cs')
-        manifest.appendChild(item)
-        
-        item = doc.createElement('item')
-        item.setAttribute('id', 'ncx')
-        item.setAttribute('href', 'book.ncx')
-        item.setAttribute('media-type', 'application/x-dtbncx+xml')
-        manifest.appendChild(item)
-        
-        doc.writexml(f, '', '', '', 'utf-8')
-        f.close()
+        self._write_file('OPS/book.opf', self.render_package())
         
         return
     
+    def render_package(self):
+        """
+        Return the OPF package file, written from the split template with
+        one formatted entry per chapter file and graphic
+        """
+        
+        items = []
+        itemrefs = []
+        for part in self.spine:
+            items.append(item_format % ('chapter' + part + '.xhtml', 'chapter' + part,
+                                        'application/xhtml+xml'))
+            itemrefs.append(itemref_format % ('chapter' + part))
+        for counter, (name, media_type) in enumerate(self.images):
+            items.append(item_format % (name, 'image%d' % (counter + 1), media_type))
+        items.append(item_format % ('css/style.css', 'main-style', 'text/cs'))
+        items.append(item_format % ('book.ncx', 'ncx', 'application/x-dtbncx+xml'))
+        
+        template = templates.get(self.template_folder + '/OPS/book.opf', split_package_template)
+        
+        return fill_template(template, [escape(self.identifier).encode('utf-8'),
+                                        escape(self.title).encode('utf-8'),
+                                        escape(self.author).encode('utf-8'),
+                                        ''.join(items), ''.join(itemrefs) or None])
+    
     def _write_navigation(self):
         logging.info("Writing Navigation Control file...")
         
-        f = open(self.base_folder + '/OPS/book.ncx', 'w')
-        doc = parse(self.template_folder + '/OPS/book.ncx')
+        self._write_file('OPS/book.ncx', self.render_navigation())
         
-        meta = doc.getElementsByTagName('meta')
-        for m in meta:
-            if m.getAttribute('name') == 'dtb:uid':
-                m.setAttribute('content', self.uid)
+        return
+    
+    def render_navigation(self):
+        """
+        Return the NCX navigation file, written from the split template
+        with one formatted entry per chapter
+        """
         
-        docTitle = doc.getElementsByTagName('docTitle')[0]
-        text = doc.createElement('text')
-        text.appendChild(doc.createTextNode(self.title))
-        docTitle.appendChild(text)
+        # Split chapters are entered at their first part
+        nav_points = [nav_point_format % (ch_num, ch_num, ch_num, ch_num) for ch_num in self.toc]
         
-        docAuthor = doc.getElementsByTagName('docAuthor')[0]
-        text = doc.createElement('text')
-        text.appendChild(doc.createTextNode(self.author))
-        docAuthor.appendChild(text)
+        template = templates.get(self.template_folder + '/OPS/book.ncx', split_navigation_template)
         
-        navMap = doc.getElementsByTagName('navMap')[0]
-        for counter, chapter in enumerate(self.chapters):
-            ch_num = str(counter + 1)
-            
-            navPoint = doc.createElement('navPoint')
-            navPoint.setAttribute('class', 'chapter')
-            navPoint.setAttribute('id', ch_num)
-            navPoint.setAttribute('playOrder', ch_num)
-            navMap.appendChild(navPoint)
-            
-            navLabel = doc.createElement('navLabel')
-            text = doc.createElement('text')
-            text.appendChild(doc.createTextNode('Chapter ' + ch_num))
-            navLabel.appendChild(text)
-            navPoint.appendChild(navLabel)
-            
-            content = doc.createElement('content')
-            content.setAttribute('src', 'chapter' + ch_num + '.xhtml')
-            navPoint.appendChild(content)
-        
-        doc.writexml(f, '', '', '', 'utf-8')
-        f.close()
-        
-        return
+        return fill_template(template, [escape(self.identifier).encode('utf-8'),
+                                        escape(self.title).encode('utf-8'),
+                                        escape(self.author).encode('utf-8'),
+                                        ''.join(nav_points) or None])
     
     def zipepub(self, dirPath, zipFilePath, includeDirInZip=False):
         
@@ -282,7 +723,7 @@ class EpubDocument(EbookDocument):
             raise OSError("dirPath argument must point to a directory. "
                 "'%s' does not." % dirPath)
         parentDir, dirToZip = os.path.split(dirPath)
-    
+        
         # Little nested function to prepare the proper archive path
         def trimPath(path):
             archivePath = path.replace(parentDir, "", 1)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+    Resolve included LyX child documents.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import re
+import mmap
+import codecs
+import logging
+
+logger = logging.getLogger('lyx2ebook')
+
+# A standard layout holding only a child document include inset
+include_pattern = re.compile("""\\\\begin_layout Standard\n+\\\\begin_inset CommandInset include\n+LatexCommand include
+filename \"([^\"\n]+)\"\n+\\\\end_inset\n+\\\\end_layout
+""")
+
+body_pattern = re.compile('\\\\begin_body(.+)\\\\end_body', re.DOTALL)
+
+# The file name of a graphics inset
+graphics_pattern = re.compile('(\\\\begin_inset Graphics\n[ \t]*filename )([^\n]+)')
+
+def graphics(text, folder):
+    """
+    Return the paths of the graphics in the text of a LyX file, whose
+    names are relative to folder
+    """
+    
+    return [os.path.join(folder, match.group(2).strip('"'))
+            for match in graphics_pattern.finditer(text)]
+
+def rebase_graphics(text, folder):
+    """
+    Make the graphics file names in the text of a child document in
+    folder relative to the including document
+    """
+    
+    # A substring search is much faster than the pattern's
+    if not folder or '\\begin_inset Graphics' not in text:
+        return text
+    
+    return graphics_pattern.sub(lambda match: match.group(1) + os.path.join(folder, match.group(2).strip('"')),
+                                text)
+
+def map_file(path, read):
+    """
+    Return the result of calling read with a read-only memory map of a
+    file, so it is not copied into a string. An empty file, which cannot
+    be mapped, is read as an empty string.
+    """
+    
+    f = open(path, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return read('')
+        
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return read(data)
+        finally:
+            data.close()
+    finally:
+        f.close()
+
+def split_includes(data, start=0, end=None):
+    """
+    Return data[start:end], a LyX file's bytes, as [text, child, text,
+    child, ..., text], the text between the child document includes
+    being buffers over data rather than copies
+    """
+    
+    if end is None:
+        end = len(data)
+    
+    pieces = []
+    for match in include_pattern.finditer(data, start, end):
+        pieces.append(buffer(data, start, match.start() - start))
+        pieces.append(match.group(1))
+        start = match.end()
+    pieces.append(buffer(data, start, end - start))
+    
+    return pieces
+
+def child_names(data):
+    """
+    Return the names of the child documents a LyX file's bytes include
+    """
+    
+    return [match.group(1) for match in include_pattern.finditer(data)]
+
+def decode(data):
+    """
+    Decode UTF-8 bytes, or a buffer over them without copying it first
+    """
+    
+    return codecs.utf_8_decode(data, 'strict', True)[0]
+
+class IncludeCycleError(Exception):
+    pass
+
+class IncludeResolver(object):
+    
+    def __init__(self, workers=1):
+        # path -> (modification stamp, body split by split_includes)
+        self.bodies = {}
+        # path -> (body with includes resolved, [(path, stamp), ...] of
+        # the document and every document it includes)
+        self.resolved = {}
+        # Threads reading child documents. Splitting a body holds the GIL,
+        # so they only pay off when the reads wait on slow storage.
+        self.workers = workers
+        self.pool = None
+        self.hits = 0
+        self.loads = 0
+    
+    def clear(self):
+        """
+        Forget the cached child documents
+        """
+        
+        self.bodies.clear()
+        self.resolved.clear()
+        
+        return
+    
+    def close(self):
+        """
+        Stop the threads reading child documents
+        """
+        
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        
+        return
+    
+    def _stamp(self, path):
+        s = os.stat(path)
+        
+        return (s.st_mtime, s.st_size)
+    
+    def _cached(self, path):
+        """
+        Return the cached body of a child document, or None if it is not
+        cached or has been modified since
+        """
+        
+        entry = self.bodies.get(path)
+        if entry is not None and entry[0] == self._stamp(path):
+            return entry[1]
+        
+        return None
+    
+    def _read_body(self, path):
+        """
+        Return the body of a child document split by split_includes,
+        reading it only if it is not cached or has been modified since
+        """
+        
+        body = self._cached(path)
+        if body is not None:
+            self.hits += 1
+            return body
+        
+        stamp = self._stamp(path)
+        
+        logger.debug("Reading child document: " + path)
+        
+        def split_body(data):
+            match = body_pattern.search(data)
+            if match is None:
+                raise ValueError("No document body in " + path)
+            
+            # Only the body is copied out of the map
+            body = split_includes(data, match.start(1), match.end(1))
+            body[0::2] = [str(text) for text in body[0::2]]
+            
+            return body
+        
+        body = map_file(path, split_body)
+        
+        self.loads += 1
+        self.bodies[path] = (stamp, body)
+        
+        return body
+    
+    def _read_bodies(self, paths):
+        """
+        Return the bodies of the child documents, reading them concurrently
+        """
+        
+        if self.workers > 1:
+            missing = [path for path in paths if self._cached(path) is None]
+            if len(missing) > 1:
+                if self.pool is None:
+                    import multiprocessing.pool
+                    self.pool = multiprocessing.pool.ThreadPool(self.workers)
+                self.pool.map(self._read_body, missing)
+        
+        return [self._read_body(path) for path in paths]
+    
+    def _cached_resolved(self, path):
+        """
+        Return the cached (resolved body, dependencies) of a child
+        document, or None if it or any document it includes has changed
+        """
+        
+        entry = self.resolved.get(path)
+        if entry is None:
+            return None
+        
+        try:
+            for dependency, stamp in entry[1]:
+                if self._stamp(dependency) != stamp:
+                    return None
+        except OSError:
+            return None
+        
+        return entry
+    
+    def resolve(self, text, file):
+        """
+        Replace each include in the text of a LyX file with the body of
+        the child document, resolving the includes of children in turn,
+        and return the result decoded from UTF-8.
+        
+        Child paths are relative to the directory of the including file.
+        """
+        
+        return decode(self._resolve(split_includes(text), file, ())[0])
+    
+    def read(self, file):
+        """
+        Return (decoded text, length in bytes) of a LyX file with its
+        includes resolved.
+        
+        The file is mapped rather than read into a string, and a document
+        without includes is decoded straight from the map.
+        """
+        
+        def resolve(data):
+            text = self._resolve(split_includes(data), file, ())[0]
+            
+            return (decode(text), len(text))
+        
+        return map_file(file, resolve)
+    
+    def _resolve(self, pieces, file, stack):
+        
+        stack = stack + (os.path.abspath(file),)
+        folder = os.path.dirname(file)
+        
+        def check_cycle(path):
+            if os.path.abspath(path) in stack:
+                raise IncludeCycleError("Include cycle: " +
+                                        " -> ".join(stack + (os.path.abspath(path),)))
+        
+        paths = []
+        for name in pieces[1::2]:
+            path = os.path.join(folder, name)
+            check_cycle(path)
+            if path not in paths:
+                paths.append(path)
+        
+        if not paths:
+            return (pieces[0], [])
+        
+        resolved = {}
+        missing = []
+        for path in paths:
+            entry = self._cached_resolved(path)
+            if entry is None:
+                missing.append(path)
+            else:
+                for dependency, stamp in entry[1]:
+                    check_cycle(dependency)
+                resolved[path] = entry
+        
+        for path, body in zip(missing, self._read_bodies(missing)):
+            body, dependencies = self._resolve(body, path, stack)
+            dependencies = [(path, self.bodies[path][0])] + dependencies
+            resolved[path] = self.resolved[path] = (body, dependencies)
+        
+        dependencies = []
+        for path in paths:
+            dependencies.extend(resolved[path][1])
+        
+        # Graphics in the children are relative to their own folders
+        text = [str(piece) for piece in pieces]
+        for counter in range(1, len(text), 2):
+            text[counter] = rebase_graphics(resolved[os.path.join(folder, pieces[counter])][0],
+                                            os.path.dirname(pieces[counter]))
+        
+        return (''.join(text), dependencies)
+    
+    def dependencies(self, file):
+        """
+        Return the child documents a LyX file includes, directly or
+        through other children.
+        
+        Only the include insets are scanned, so the text of the book is
+        neither built nor cached.
+        """
+        
+        paths = []
+        self._walk(file, (), paths)
+        
+        return paths
+    
+    def _walk(self, file, stack, paths):
+        
+        stack = stack + (os.path.abspath(file),)
+        folder = os.path.dirname(file)
+        
+        for name in map_file(file, child_names):
+            path = os.path.join(folder, name)
+            if os.path.abspath(path) in stack:
+                raise IncludeCycleError("Include cycle: " +
+                                        " -> ".join(stack + (os.path.abspath(path),)))
+            
+            if path not in paths:
+                paths.append(path)
+                self._walk(path, stack, paths)
+        
+        return
+
+# Child documents shared by every LyX document in the process
+includes = IncludeResolver()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+    Configure logging for the lyx2ebook scripts.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+_configured = False
+
+def configure_logging(file_name="logging.conf"):
+    """
+    Configure logging from the configuration file, only the first time
+    it is called in the process.
+    
+    The document modules only get their loggers, so the scripts call this
+    once they know they have work to do.
+    """
+    global _configured
+    
+    if not _configured:
+        import logging.config
+        logging.config.fileConfig(file_name)
+        _configured = True
+    
+    return
@@ -8,48 +8,317 @@
     it under the terms of the GNU General Public License as published by
     the Free Software Foundation, either version 3 of the License, or
     (at your option) any later version.
-
+    
     This program is distributed in the hope that it will be useful,
     but WITHOUT ANY WARRANTY; without even the implied warranty of
     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
     GNU General Public License for more details.
-
+    
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
 import os
-import logging
 import re
-
-from lepl import *
+import logging
+import itertools
 
 from EbookDocument import *
+from IncludeResolver import includes, IncludeCycleError
 
-logging.config.fileConfig("logging.conf")
 logger = logging.getLogger('lyx2ebook')
 
+# Compiled parsers shared by every LyxDocument in the process
+_parser = None
+_body_parser = None
+
+# A line the grammar reads as a sentence: words separated by single spaces
+# or tabs, possibly followed by spaces, and not starting with a backslash
+sentence_pattern = re.compile(u'[^\\\\][^ \t\n\r\x0b\x0c]*(?:[ \t][^ \t\n\r\x0b\x0c]+)*[ \t]*\\Z')
+
+BLANK = ('blank', u'', False)
+
+# Documents shorter than this, in characters, are parsed in one process,
+# being parsed faster than the pool starts
+parallel_size = 256 * 1024
+
+def tokenize(text):
+    """
+    Split the text of a LyX document into (kind, value, sentence) tokens,
+    one per line. A 'command' line starts with a backslash and its value
+    is the rest of the line, a 'text' line is its own value, and a 'blank'
+    line is empty. sentence tells whether the value is read as a sentence.
+    An unterminated last line is a 'partial' token, which no rule accepts.
+    """
+    
+    lines = text.split('\n')
+    last = lines.pop()
+    
+    tokens = []
+    append = tokens.append
+    match = sentence_pattern.match
+    for line in lines:
+        if line.endswith('\r'):
+            line = line[:-1]
+        
+        if not line:
+            append(BLANK)
+        elif line[0] == '\\':
+            value = line[1:]
+            append(('command', value, match(value) is not None))
+        else:
+            append(('text', line, match(line) is not None))
+    
+    if last:
+        append(('partial', last, False))
+    
+    return tokens
+
+def build_grammar(body_only=False):
+    """
+    Build the LyX grammar over the tokens of tokenize and return its root
+    matcher, or with body_only the matcher of the layouts inside a document
+    body.
+    
+    It reads the same documents into the same parse tree as the grammar
+    over characters, one line at a time.
+    """
+    
+    # lepl is only loaded once a document is parsed with it
+    from lepl import function_matcher, function_matcher_factory
+    
+    @function_matcher_factory()
+    def Line(kind, value=None, sentence=False):
+        """
+        Match a token of a kind, with the given value or, if sentence, any
+        value read as a sentence
+        """
+        
+        def match(support, stream):
+            if stream:
+                token = stream[0]
+                if token[0] == kind and (token[1] == value or value is None and (token[2] or not sentence)):
+                    return ([token[1]], stream[1:])
+        
+        return match
+    
+    @function_matcher
+    def BeginInset(support, stream):
+        """
+        Match the first line of an inset as 'begin_inset', the space and
+        the sentence following it
+        """
+        
+        if stream:
+            kind, value, sentence = stream[0]
+            if kind == 'command' and value.startswith('begin_inset'):
+                if value == 'begin_inset':
+                    return (['begin_inset'], stream[1:])
+                if value[11] in ' \t' and sentence_pattern.match(value, 12):
+                    return (['begin_inset', value[11], value[12:]], stream[1:])
+    
+    @function_matcher
+    def Comment(support, stream):
+        if stream:
+            kind, value, sentence = stream[0]
+            if kind == 'text' and value.startswith('#') and '\r' not in value:
+                return ([value], stream[1:])
+    
+    # Match the new lines ending a line
+    newlines = ~Line('blank')[:]
+    
+    sentence = Line('text', sentence=True)
+    
+    comment = Comment() & newlines
+    
+    # Match command in the format of "\XXX YYY ZZZ ..."
+    command = Line('command', sentence=True) & newlines
+    
+    inset = BeginInset() & newlines & (sentence & newlines)[:] & ~Line('command', 'end_inset') & newlines > list
+    content = ((sentence & newlines) | inset)[:]
+    
+    # Main LyX document definition
+    standard = Line('command', 'begin_layout Standard') & newlines & content & ~Line('command', 'end_layout') & newlines > list
+    # Layouts after the chapter heading are followed by a blank line
+    chapter = Line('command', 'begin_layout Chapter') & newlines & (sentence & newlines)[:] & ~Line('command', 'end_layout') & newlines & standard[:] & ~Line('blank')[1:] > list
+    date = Line('command', 'begin_layout Date') & newlines & content & ~Line('command', 'end_layout') & newlines > list
+    author = Line('command', 'begin_layout Author') & newlines & (sentence & newlines)[:] & ~Line('command', 'end_layout') & newlines > list
+    title = Line('command', 'begin_layout Title') & newlines & (sentence & newlines)[:] & ~Line('command', 'end_layout') & newlines > list
+    body_content = (title | author | ~date | standard | chapter)
+    if body_only:
+        return body_content[:]
+    
+    body = Line('command', 'begin_body') & newlines & body_content[:] & ~Line('command', 'end_body') & newlines > list
+    header = Line('command', 'begin_header') & newlines & command[:] & ~Line('command', 'end_header') & newlines > list
+    document = Line('command', 'begin_document') & newlines & header & body & ~Line('command', 'end_document') & newlines > list
+    root = document | command | ~comment
+    lyx = root[:]
+    
+    return lyx
+
+def get_parser():
+    """
+    Return the compiled LyX parser, building it on first use.
+    
+    The grammar and its rewritten matcher graph are kept for the lifetime
+    of the process, so only the first document parsed pays for them.
+    """
+    global _parser
+    
+    if _parser is None:
+        logger.debug("Compiling LyX grammar")
+        _parser = build_grammar().get_parse_items()
+    
+    return _parser
+
+def parse_string(text):
+    """
+    Parse the text of a LyX document with the compiled parser
+    """
+    
+    return get_parser()(tokenize(text))
+
+def get_body_parser():
+    """
+    Return the compiled parser of the layouts inside a document body,
+    building it on first use
+    """
+    global _body_parser
+    
+    if _body_parser is None:
+        logger.debug("Compiling LyX body grammar")
+        _body_parser = build_grammar(True).get_parse_items()
+    
+    return _body_parser
+
+def parse_body(text):
+    """
+    Parse layouts cut from the body of a LyX document
+    """
+    
+    return get_body_parser()(tokenize(text))
+
+def split_body(text, size):
+    """
+    Find the layouts in the body of a LyX document and cut them before
+    chapters into chunks of at least size characters.
+    
+    Return (start, end, chunks), text[start:end] being the layouts, or
+    None if the document has no body.
+    """
+    
+    start = text.find('\\begin_body')
+    end = text.rfind('\\end_body')
+    if start < 0 or end < start:
+        return None
+    
+    start = text.find('\\begin_layout', start, end)
+    if start < 0:
+        return None
+    
+    chunks = []
+    chunk = start
+    boundary = text.find('\n\\begin_layout Chapter', start, end)
+    while boundary >= 0:
+        if boundary + 1 - chunk >= size:
+            chunks.append(text[chunk:boundary + 1])
+            chunk = boundary + 1
+        boundary = text.find('\n\\begin_layout Chapter', boundary + 1, end)
+    chunks.append(text[chunk:end])
+    
+    return (start, end, chunks)
+
+def parse_parallel(text, workers):
+    """
+    Parse the text of a LyX document as parse_string does, parsing its
+    body in chunks cut before chapters over a pool of worker processes
+    """
+    
+    if len(text) < parallel_size:
+        return parse_string(text)
+    
+    cut = split_body(text, len(text) // (workers * 4))
+    if cut is None or len(cut[2]) < 2:
+        return parse_string(text)
+    start, end, chunks = cut
+    
+    # Parse the document without its layouts, then put them back
+    result = parse_string(text[:start] + text[end:])
+    body = None
+    for element in result:
+        if type(element) is list and element[0].startswith('begin_document'):
+            for part in element:
+                if type(part) is list and part[0].startswith('begin_body'):
+                    body = part
+    if body is None:
+        return parse_string(text)
+    
+    # Compiled before the pool so forked workers inherit the parser
+    get_body_parser()
+    
+    import multiprocessing
+    
+    pool = multiprocessing.Pool(min(workers, len(chunks)))
+    try:
+        # map keeps the chunks in document order
+        for layouts in pool.map(parse_body, chunks):
+            body.extend(layouts)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    
+    return result
+
 class LyxDocument(EbookDocument):
     
     def __init__(self):
         super(LyxDocument, self).__init__()
+        
+        # Number of processes parsing the chapters of the document body
+        self.parse_workers = 1
     
     def process_standard(self, content):
         
-        text = ""
+        pieces = []
         for element in content:
             if type(element) is unicode or type(element) is str:
                 if element != 'begin_layout Standard': 
-                    text += element
+                    pieces.append(element)
         
-        return text
+        return "".join(pieces)
+    
+    def process_images(self, content):
+        """
+        Return (offset in the paragraph text, file path) of each graphics
+        inset in a standard layout, or None if it has none
+        """
+        
+        images = None
+        offset = 0
+        for element in content:
+            if type(element) is unicode or type(element) is str:
+                if element != 'begin_layout Standard':
+                    offset += len(element)
+            elif len(element) > 2 and element[0] == 'begin_inset' and element[2] == 'Graphics':
+                for line in element[3:]:
+                    line = line.strip()
+                    if line.startswith('filename '):
+                        if images is None:
+                            images = []
+                        # Names are relative to the master document
+                        images.append((offset, os.path.join(os.path.dirname(self.file_name),
+                                                            line[9:].strip('"'))))
+        
+        return images
     
     def process_chapter(self, title, content):
         logger.debug("Adding chapter: " + title)
         chapter = Chapter(title)
         for standard in content:
-            chapter.add_paragraph(self.process_standard(standard))
+            chapter.add_paragraph(self.process_standard(standard), self.process_images(standard))
         
         #print "TEXT: ", chapter.text
         self.add_chapter(chapter)
@@ -113,68 +382,205 @@ class LyxDocument(EbookDocument):
         
         return
     
-    def preprocess(self, text):
+    def preprocess(self, file):
         """
-        Handle included LyX child document
+        Read the LyX document, handling included LyX child documents, and
+        return (its decoded text, its length in bytes)
         """
-        def replace_included(match):
-            #print 'Opening: ', match.group(1)
-            f = open(match.group(1), 'r')
-            result = re.search('\\\\begin_body(.+)\\\\end_body', f.read(), re.DOTALL).group(1)
-            #print 'Content: ', result
-            f.close()
-            return result
         
-        return re.sub("""\\\\begin_layout Standard\n+\\\\begin_inset CommandInset include\n+LatexCommand include
-filename \"([\w \.]+)\"\n+\\\\end_inset\n+\\\\end_layout
-""", replace_included, text)
+        return includes.read(file)
     
     def parse(self, file):
         
         super(LyxDocument, self).set_file(file)
         
-        # Match one or more new line
-        newlines = ~Newline()[1:]
+        # Read and parse the LyX document
+        preprocessed, size = self.measure('preprocess', self.preprocess, file)
+        if self.parse_workers > 1:
+            result = self.measure('parse', parse_parallel, preprocessed, self.parse_workers)
+        else:
+            result = self.measure('parse', parse_string, preprocessed)
         
-        backslash = ~Literal('\\')
+        self.measure('process_root', self.process_root, result)
         
-        # Match sentence
-        sentence = AnyBut('\\') & Word()[:1] & (Space() & Word())[:] & Space()[:] > "".join
+        if self.metrics is not None:
+            self.metrics.add_size('input_bytes', size)
+            self.metrics.add_size('chapters', len(self.chapters))
+            self.metrics.add_size('paragraphs', sum([len(chapter.paragraphs) for chapter in self.chapters]))
         
-        # Match comment which starts a new line with #
-        comment = Literal('#') & AnyBut("\n\r")[:] & newlines
+        return
+    
+    def read_lines(self, file, body_only=False, stack=()):
+        """
+        Yield the lines of a LyX file one at a time, replacing each
+        included child document inset with the lines of the child's body.
+        Graphics file names are made relative to the current directory.
+        """
         
-        # Match command in the format of "\XXX YYY ZZZ ..."
-        command = backslash & sentence & newlines > "".join
+        stack = stack + (os.path.abspath(file),)
         
-        inset = backslash & Literal('begin_inset') & (Space() & sentence)[:1] & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_inset') & newlines > list
-        content = ((sentence & newlines) | inset)[:]
+        f = open(file, 'r')
         
-        # Main LyX document definition
-        #layout = backslash & Literal('begin_layout') & (Space() & Word())[:] & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines > list
-        standard = backslash & Literal('begin_layout Standard') & newlines & content & backslash & ~Literal('end_layout') & newlines > list
-        chapter = backslash & Literal('begin_layout Chapter') & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines & standard[:] & newlines > list
-        date = backslash & Literal('begin_layout Date') & newlines & content & backslash & ~Literal('end_layout') & newlines > list
-        author = backslash & Literal('begin_layout Author') & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines > list
-        title = backslash & Literal('begin_layout Title') & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines > list
-        body_content = (title | author | ~date | standard | chapter)
-        body = backslash & Literal('begin_body') & newlines & body_content[:] & backslash & ~Literal('end_body') & newlines > list
-        header = backslash & Literal('begin_header') & newlines & command[:] & backslash & ~Literal('end_header') & newlines > list
-        document = backslash & Literal('begin_document') & newlines & header & body & backslash & ~Literal('end_document') & newlines > list
-        root = document | command | ~comment
-        lyx = root[:]
+        try:
+            in_body = not body_only
+            inset = None
+            graphics = False
+            
+            for line in f:
+                line = line.decode('utf-8').rstrip('\r\n')
+                
+                if body_only and not in_body:
+                    in_body = (line == '\\begin_body')
+                    continue
+                
+                if body_only and line == '\\end_body':
+                    break
+                
+                if inset is not None:
+                    # Inside an include inset, wait for its filename
+                    inset.append(line)
+                    if line == '\\end_inset':
+                        included = None
+                        for element in inset:
+                            if element.startswith('filename "'):
+                                included = element[10:-1]
+                        
+                        if included is None:
+                            for element in inset:
+                                yield element
+                        else:
+                            included = os.path.join(os.path.dirname(file), included)
+                            if os.path.abspath(included) in stack:
+                                raise IncludeCycleError("Include cycle: " +
+                                                        " -> ".join(stack + (os.path.abspath(included),)))
+                            
+                            logger.debug("Including child document: " + included)
+                            for element in self.read_lines(included, True, stack):
+                                yield element
+                        
+                        inset = None
+                    continue
+                
+                if line == '\\begin_inset CommandInset include':
+                    inset = [line]
+                    continue
+                
+                if line == '\\begin_inset Graphics':
+                    graphics = True
+                elif graphics and line == '\\end_inset':
+                    graphics = False
+                elif graphics and line.strip().startswith('filename '):
+                    line = '\tfilename ' + os.path.join(os.path.dirname(file), line.strip()[9:].strip('"'))
+                
+                yield line
+        finally:
+            f.close()
+    
+    def read_chapters(self, file):
+        """
+        Read the LyX document line by line and yield each chapter as soon
+        as its last paragraph has been read
+        """
         
-        # Read LyX document
-        f = open(file, 'r')
+        chapter = None
+        # Open layouts as [name, text pieces, contains other layouts,
+        # (offset, path) of its graphics]
+        layouts = []
+        insets = 0
+        graphics = False
+        
+        for line in self.read_lines(file):
+            
+            if line.startswith('\\begin_inset'):
+                insets += 1
+                graphics = (insets == 1 and line == '\\begin_inset Graphics')
+            elif insets:
+                if line == '\\end_inset':
+                    insets -= 1
+                elif graphics and layouts and line.startswith('\tfilename '):
+                    layouts[-1][3].append((sum(map(len, layouts[-1][1])), line[10:]))
+            
+            elif line.startswith('\\begin_layout '):
+                name = line[14:].strip()
+                if name != 'Standard' and chapter is not None:
+                    yield chapter
+                    chapter = None
+                
+                if layouts:
+                    layouts[-1][2] = True
+                layouts.append([name, [], False, []])
+            
+            elif line == '\\end_layout' and layouts:
+                name, pieces, nested, images = layouts.pop()
+                text = "".join(pieces)
+                
+                if nested:
+                    # Layout only wrapped an included child document
+                    pass
+                elif name == 'Standard':
+                    if chapter is not None:
+                        chapter.add_paragraph(text, images or None)
+                elif name == 'Chapter':
+                    logger.debug("Adding chapter: " + text)
+                    chapter = Chapter(text)
+                elif name == 'Title':
+                    self.title = text
+                elif name == 'Author':
+                    self.author = text
+            
+            elif line.startswith('\\lyxformat '):
+                logger.info('LyX document format version ' + line[11:])
+            
+            elif layouts and line and not line.startswith('\\'):
+                layouts[-1][1].append(line)
+        
+        if chapter is not None:
+            yield chapter
+        
+        return
+    
+    def _measure_chapters(self, chapters):
+        """
+        Yield the chapters read lazily, recording the reading of each as
+        the parse stage and counting the chapters and paragraphs
+        """
+        
+        while True:
+            try:
+                chapter = self.measure('parse', next, chapters)
+            except StopIteration:
+                return
+            
+            self.metrics.add_size('chapters', 1)
+            self.metrics.add_size('paragraphs', len(chapter.paragraphs))
+            
+            yield chapter
+    
+    def parse_stream(self, file):
+        """
+        Parse the LyX document line by line without loading it whole.
+        
+        The title and author are read along with the first chapter, the
+        remaining chapters are only read as self.chapters is iterated, so
+        self.chapters can be iterated once.
+        """
+        
+        super(LyxDocument, self).set_file(file)
         
-        # Parse the LyX document
-        preprocessed = self.preprocess(f.read())
-        print preprocessed
-        result = lyx.parse(preprocessed)
+        chapters = self.read_chapters(file)
         
-        # Close the opened LyX document
-        f.close()
+        if self.metrics is not None:
+            size = 0
+            for path in [file] + includes.dependencies(file):
+                size += os.path.getsize(path)
+            self.metrics.add_size('input_bytes', size)
+            chapters = self._measure_chapters(chapters)
         
-        self.process_root(result)
+        try:
+            first = next(chapters)
+        except StopIteration:
+            self.chapters = []
+        else:
+            self.chapters = itertools.chain([first], chapters)
         
         return
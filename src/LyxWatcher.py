@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+    Watch a LyX document and reconvert it when it changes.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import time
+import logging
+
+import LyxDocument
+from IncludeResolver import includes
+from TemplateCache import templates
+
+logger = logging.getLogger('lyx2ebook')
+
+class LyxWatcher(object):
+    
+    def __init__(self, lyx_file, formats, convert, interval=1.0):
+        """
+        Watch lyx_file for the output formats. convert is called with the
+        list of formats whose output is out of date.
+        """
+        
+        self.lyx_file = lyx_file
+        self.formats = formats
+        self.convert = convert
+        self.interval = interval
+        self.template_folder = "template"
+        
+        # path -> modification stamp when last converted
+        self.stamps = {}
+    
+    def _stamp(self, path):
+        try:
+            s = os.stat(path)
+        except OSError:
+            return None
+        
+        return (s.st_mtime, s.st_size)
+    
+    def inputs(self):
+        """
+        Return a dictionary of each watched file to the formats whose
+        output depends on it
+        """
+        
+        watched = {}
+        
+        try:
+            lyx_files = [self.lyx_file] + includes.dependencies(self.lyx_file)
+        except Exception, e:
+            # Keep watching what we know of while the document is broken
+            logger.warning("Cannot read includes of %s: %s" % (self.lyx_file, e))
+            lyx_files = [path for path in self.stamps.keys()
+                         if not path.startswith(self.template_folder + os.sep)]
+            if self.lyx_file not in lyx_files:
+                lyx_files.append(self.lyx_file)
+        
+        for path in lyx_files:
+            watched[path] = self.formats
+        
+        # Only the ePub output is built from the templates
+        if 'epub' in self.formats:
+            for (dir_path, dir_names, file_names) in os.walk(self.template_folder):
+                for file_name in file_names:
+                    watched[os.path.join(dir_path, file_name)] = ['epub']
+        
+        return watched
+    
+    def poll(self):
+        """
+        Return the formats whose inputs changed since the last poll
+        """
+        
+        changed = []
+        stamps = {}
+        for path, formats in self.inputs().items():
+            stamps[path] = self._stamp(path)
+            if stamps[path] != self.stamps.get(path):
+                logger.debug("Changed: " + path)
+                for format in formats:
+                    if format not in changed:
+                        changed.append(format)
+        
+        self.stamps = stamps
+        
+        return [format for format in self.formats if format in changed]
+    
+    def run(self):
+        """
+        Convert the document, then poll for changes and reconvert the
+        outputs they affect until interrupted
+        """
+        
+        # Build the grammar and load the templates before the first change
+        LyxDocument.get_parser()
+        templates.load(self.template_folder)
+        
+        while True:
+            changed = self.poll()
+            if changed:
+                logger.info("Converting %s to %s" % (self.lyx_file, ", ".join(changed)))
+                start = time.time()
+                try:
+                    self.convert(changed)
+                    logger.info("Converted in %.3fs, watching for changes..." % (time.time() - start))
+                except Exception:
+                    logger.exception("Conversion failed, watching for changes...")
+            
+            time.sleep(self.interval)
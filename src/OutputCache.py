@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+    A cache of converted eBook files keyed by their inputs.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from IncludeResolver import includes, graphics, map_file
+
+logger = logging.getLogger('lyx2ebook')
+
+# Bump when the cached files or their keys change meaning
+CACHE_VERSION = 1
+
+# Source modules the output of each format depends on, besides the parser
+sources = {
+    'epub': ['EpubDocument', 'EpubArchive', 'TemplateCache'],
+    'rtf': ['RTFDocument'],
+    'txt': ['TextDocument'],
+}
+parser_sources = ['LyxDocument', 'EbookDocument', 'IncludeResolver']
+
+def output_file(lyx_file, format):
+    """
+    Return the name of the file converting lyx_file to format writes
+    """
+    
+    return lyx_file.rsplit('.', 1)[0] + '.' + format
+
+class OutputCache(object):
+    
+    def __init__(self, folder, max_bytes=200 * 1048576, template_folder="template"):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.template_folder = template_folder
+        self.hits = 0
+        self.misses = 0
+    
+    def _hash_file(self, h, path):
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            f.close()
+        
+        return
+    
+    def key(self, lyx_file, format, options=''):
+        """
+        Return the cache key of converting lyx_file to format with the
+        given writer options: a hash of the document and every child it
+        includes, their graphics, the templates used, and the converter
+        itself
+        """
+        
+        h = hashlib.sha1('lyx2ebook cache %d\0%s\0%s\0' % (CACHE_VERSION, format, options))
+        
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in parser_sources + sources[format]:
+            h.update(name + '\0')
+            self._hash_file(h, os.path.join(here, name + '.py'))
+        
+        folder = os.path.dirname(lyx_file)
+        images = []
+        for path in [lyx_file] + includes.dependencies(lyx_file):
+            h.update('\0' + os.path.relpath(path, folder or '.') + '\0')
+            self._hash_file(h, path)
+            
+            if format == 'epub':
+                images.extend(map_file(path, lambda data: graphics(data, os.path.dirname(path))))
+        
+        for path in images:
+            h.update('\0' + os.path.relpath(path, folder or '.') + '\0')
+            if os.access(path, os.R_OK):
+                self._hash_file(h, path)
+        
+        if format == 'epub':
+            for (dir_path, dir_names, file_names) in sorted(os.walk(self.template_folder)):
+                for file_name in sorted(file_names):
+                    path = os.path.join(dir_path, file_name)
+                    h.update('\0' + os.path.relpath(path, self.template_folder) + '\0')
+                    self._hash_file(h, path)
+        
+        return h.hexdigest()
+    
+    def restore(self, key, file_name):
+        """
+        Copy the file cached under key to file_name, returning whether
+        there was one
+        """
+        
+        path = os.path.join(self.folder, key)
+        
+        # Another process sharing the folder may evict the entry at any time
+        try:
+            shutil.copyfile(path, file_name)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return False
+        
+        # Most recently used entries are evicted last
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        
+        logger.info("Restored %s from the cache" % file_name)
+        self.hits += 1
+        
+        return True
+    
+    def store(self, key, file_name):
+        """
+        Keep a copy of file_name under key, evicting the least recently
+        used entries beyond the cache size
+        """
+        
+        if not os.access(self.folder, os.F_OK):
+            os.makedirs(self.folder)
+        
+        # Copy then rename, so a reader never sees part of an entry
+        handle, temp = tempfile.mkstemp(dir=self.folder, prefix='.')
+        os.close(handle)
+        shutil.copyfile(file_name, temp)
+        os.rename(temp, os.path.join(self.folder, key))
+        
+        self.evict()
+        
+        return
+    
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.folder):
+            if name.startswith('.'):
+                continue
+            try:
+                s = os.stat(os.path.join(self.folder, name))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((s.st_mtime, s.st_size, name))
+            total += s.st_size
+        
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            logger.debug("Evicting cached file: " + name)
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError, e:
+                # Already evicted by another process
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
+        
+        return
@@ -20,13 +20,47 @@
 """
 
 import os
+import re
 import logging
 
 from EbookDocument import *
 
-logging.config.fileConfig("logging.conf")
 logger = logging.getLogger('lyx2ebook')
 
+# Characters written as control symbols or Unicode escapes
+special_pattern = re.compile(u'[\\\\{}]|[^\x00-\x7f]')
+
+def escape_character(match):
+    char = match.group(0)
+    if char in u'\\{}':
+        return '\\' + char
+    
+    code = ord(char)
+    if code > 0xffff:
+        # A surrogate pair, on wide builds
+        code -= 0x10000
+        return escape_code(0xd800 + (code >> 10)) + escape_code(0xdc00 + (code & 0x3ff))
+    
+    return escape_code(code)
+
+def escape_code(code):
+    """
+    Return the \\uN escape of a UTF-16 code unit, N being a signed 16-bit
+    number, followed by ? for readers without Unicode
+    """
+    
+    if code > 0x7fff:
+        code -= 0x10000
+    
+    return '\\u%d?' % code
+
+def escape(text):
+    """
+    Escape text for RTF, which only holds ASCII
+    """
+    
+    return str(special_pattern.sub(escape_character, text))
+
 class RTFDocument(EbookDocument):
     
     def __init__(self):
@@ -38,6 +72,13 @@ class RTFDocument(EbookDocument):
         
         logging.info("Converting to RTF...")
         
+        self.measure('rtf', self._write_rtf)
+        self.record_output()
+        
+        return
+    
+    def _write_rtf(self):
+        
         f = open(self.file_name, 'w')
         
         f.write('{\\rtf\\ansi\\ansicpg1252\\cocoartf949\\cocoasubrtf540')
@@ -46,16 +87,16 @@ class RTFDocument(EbookDocument):
         f.write('{\\colortbl;\\red255\\green255\\blue255;}')
         
         f.write('\\pard\\pardeftab720\\f0')
-        f.write('\\fs36 \\cf0 ' + self.title + '\\\n')
-        f.write('by ' + self.author + '\\\n')
+        f.write('\\fs36 \\cf0 ' + escape(self.title) + '\\\n')
+        f.write('by ' + escape(self.author) + '\\\n')
         
         for counter, chapter in enumerate(self.chapters):
             chapter_num = str(counter + 1)
             f.write('\\\n')
-            f.write('\\fs32 Chapter ' + chapter_num + ' ' + chapter.title + '\\\n')
+            f.write('\\fs32 Chapter ' + chapter_num + ' ' + escape(chapter.title) + '\\\n')
             
             for paragraph in chapter.paragraphs:
-                f.write('\\fs22 ' + paragraph.text + '\\\n')
+                f.write('\\fs22 ' + escape(paragraph.text) + '\\\n')
         
         f.write('}')
         
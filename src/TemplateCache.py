@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+    A process-wide cache of eBook template files.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import logging
+from xml.dom.minidom import parseString
+
+logger = logging.getLogger('lyx2ebook')
+
+class TemplateCache(object):
+    
+    def __init__(self):
+        # (path, builder) -> (modification stamp, value)
+        self.entries = {}
+        self.hits = 0
+        self.loads = 0
+    
+    def _stamp(self, path):
+        s = os.stat(path)
+        
+        return (s.st_mtime, s.st_size)
+    
+    def load(self, folder):
+        """
+        Read every file under the template folder into the cache
+        """
+        
+        for (dir_path, dir_names, file_names) in os.walk(folder):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                self.get(path)
+                if file_name.endswith('.xml') or file_name.endswith('.opf') \
+                        or file_name.endswith('.ncx') or file_name.endswith('.xhtml'):
+                    self.get(path, parseString)
+        
+        return
+    
+    def get(self, path, build=None):
+        """
+        Return the contents of a template file, or the result of calling
+        build on them, reusing it until the file is modified
+        """
+        
+        path = os.path.normpath(path)
+        stamp = self._stamp(path)
+        
+        entry = self.entries.get((path, build))
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            return entry[1]
+        
+        if build is None:
+            logger.debug("Loading template: " + path)
+            f = open(path, 'rb')
+            value = f.read()
+            f.close()
+        else:
+            value = build(self.get(path))
+        
+        self.loads += 1
+        self.entries[(path, build)] = (stamp, value)
+        
+        return value
+    
+    def parse(self, path):
+        """
+        Return a fresh copy of the DOM document of a template file
+        """
+        
+        return self.get(path, parseString).cloneNode(True)
+    
+    def clear(self):
+        self.entries = {}
+        
+        return
+
+# Template cache shared by every eBook document in the process
+templates = TemplateCache()
@@ -19,11 +19,11 @@
 
 """
 
+import codecs
 import logging
 
 from EbookDocument import EbookDocument
 
-logging.config.fileConfig("logging.conf")
 logger = logging.getLogger('lyx2ebook')
 
 class TextDocument(EbookDocument):
@@ -38,6 +38,7 @@ class TextDocument(EbookDocument):
         self.chapters = source.chapters
         self.title = source.title
         self.author = source.author
+        self.metrics = source.metrics
         
         return
     
@@ -45,7 +46,14 @@ class TextDocument(EbookDocument):
         
         logging.info("Converting to text...")
         
-        f = open(self.file_name, 'w')
+        self.measure('text', self._write_text)
+        self.record_output()
+        
+        return
+    
+    def _write_text(self):
+        
+        f = codecs.open(self.file_name, 'w', 'utf-8')
         
         f.write(self.title + '\n')
         f.write('by ' + self.author + '\n\n\n')
@@ -0,0 +1,860 @@
+#!/usr/bin/env python
+"""
+    Benchmarks for lyx2ebook.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import zipfile
+import random
+import multiprocessing
+import logging
+from xml.dom.minidom import parseString
+
+import LyxDocument
+import EpubDocument
+from EbookDocument import Chapter
+from TemplateCache import templates
+from EpubArchive import EpubArchive
+from OutputCache import OutputCache, output_file
+import lyx2ebook
+import lyxcorpus
+from IncludeResolver import IncludeResolver
+from LogConfig import configure_logging
+
+logger = logging.getLogger('lyx2ebook')
+
+def timed(function, *args):
+    """
+    Return the wall time in seconds taken by a call
+    """
+    
+    start = time.time()
+    function(*args)
+    
+    return time.time() - start
+
+def parse_file(lyx_file):
+    lyx = LyxDocument.LyxDocument()
+    lyx.parse(lyx_file)
+
+def build_parser():
+    LyxDocument._parser = None
+    LyxDocument.get_parser()
+
+def bench_grammar(lyx_file, runs=5):
+    """
+    Compare the grammar construction saved by the cached parser against
+    the time spent parsing the file itself
+    """
+    
+    build = 0.0
+    for i in range(runs):
+        build += timed(build_parser)
+    
+    parse = 0.0
+    for i in range(runs):
+        parse += timed(parse_file, lyx_file)
+    
+    print 'Grammar build:            %.3fs per file' % (build / runs)
+    print 'Parse (cached grammar):   %.3fs per file' % (parse / runs)
+    print 'Parse (grammar per file): %.3fs per file' % ((build + parse) / runs)
+    
+    return
+
+def build_character_grammar():
+    """
+    Build the LyX grammar over the characters of a document and return its
+    root matcher, the way LyxDocument parsed before the grammar over line
+    tokens, to check and time that grammar against
+    """
+    
+    from lepl import AnyBut, Literal, Newline, Space, Word
+    
+    # Match one or more new line
+    newlines = ~Newline()[1:]
+    
+    backslash = ~Literal('\\')
+    
+    # Match sentence
+    sentence = AnyBut('\\') & Word()[:1] & (Space() & Word())[:] & Space()[:] > "".join
+    
+    # Match comment which starts a new line with #
+    comment = Literal('#') & AnyBut("\n\r")[:] & newlines
+    
+    # Match command in the format of "\XXX YYY ZZZ ..."
+    command = backslash & sentence & newlines > "".join
+    
+    inset = backslash & Literal('begin_inset') & (Space() & sentence)[:1] & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_inset') & newlines > list
+    content = ((sentence & newlines) | inset)[:]
+    
+    # Main LyX document definition
+    #layout = backslash & Literal('begin_layout') & (Space() & Word())[:] & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines > list
+    standard = backslash & Literal('begin_layout Standard') & newlines & content & backslash & ~Literal('end_layout') & newlines > list
+    chapter = backslash & Literal('begin_layout Chapter') & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines & standard[:] & newlines > list
+    date = backslash & Literal('begin_layout Date') & newlines & content & backslash & ~Literal('end_layout') & newlines > list
+    author = backslash & Literal('begin_layout Author') & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines > list
+    title = backslash & Literal('begin_layout Title') & newlines & (sentence & newlines)[:] & backslash & ~Literal('end_layout') & newlines > list
+    body_content = (title | author | ~date | standard | chapter)
+    body = backslash & Literal('begin_body') & newlines & body_content[:] & backslash & ~Literal('end_body') & newlines > list
+    header = backslash & Literal('begin_header') & newlines & command[:] & backslash & ~Literal('end_header') & newlines > list
+    document = backslash & Literal('begin_document') & newlines & header & body & backslash & ~Literal('end_document') & newlines > list
+    root = document | command | ~comment
+    lyx = root[:]
+    
+    return lyx
+
+def bench_lexer(sizes=(8, 32, 128), paragraphs=8, length=40, runs=3):
+    """
+    Check the grammar over line tokens gives the same parse tree as the
+    grammar over characters on books of each number of chapters, and
+    compare their throughput. The grammar over characters is only timed
+    once, being slow enough for one run.
+    """
+    
+    characters = build_character_grammar().get_parse_string()
+    LyxDocument.get_parser()
+    
+    folder = tempfile.mkdtemp()
+    try:
+        for chapters in sizes:
+            master = lyxcorpus.write_corpus(os.path.join(folder, str(chapters)), chapters,
+                                            paragraphs, length, 0, 0.02)
+            f = open(master, 'r')
+            text = f.read().decode('utf-8')
+            f.close()
+            
+            if characters(text) != LyxDocument.parse_string(text):
+                raise AssertionError("Parse trees differ with %d chapters" % chapters)
+            
+            size = len(text.encode('utf-8')) / 1024.0
+            for name, parse in [('characters', characters),
+                                ('tokenize only', LyxDocument.tokenize),
+                                ('tokens', LyxDocument.parse_string)]:
+                count = parse is characters and 1 or runs
+                total = 0.0
+                for i in range(count):
+                    total += timed(parse, text)
+                
+                print 'Parse of %5.0f KB over %-14s %.3fs, %7.1f KB/s' % \
+                    (size, name + ':', total / count, size * count / total)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+def bench_parse(max_workers=4, chapters=64, paragraphs=40, length=80, runs=3):
+    """
+    Compare parsing a synthetic book with its chapters cut over 1 to
+    max_workers processes, checking the parse trees are the same
+    """
+    
+    folder = tempfile.mkdtemp()
+    try:
+        master = lyxcorpus.write_corpus(folder, chapters, paragraphs, length, 0, 0.02)
+        f = open(master, 'r')
+        text = f.read().decode('utf-8')
+        f.close()
+        
+        # Shorter documents are parsed in one process
+        if len(text) < LyxDocument.parallel_size:
+            raise AssertionError("Book of %d characters too short for a parallel parse" % len(text))
+        
+        LyxDocument.get_body_parser()
+        reference = LyxDocument.parse_string(text)
+        
+        serial = 0.0
+        for i in range(runs):
+            serial += timed(LyxDocument.parse_string, text)
+        print 'Parse of %d KB, serial:       %.3fs' % (len(text) // 1024, serial / runs)
+        
+        for workers in range(2, max_workers + 1):
+            if LyxDocument.parse_parallel(text, workers) != reference:
+                raise AssertionError("Parse tree differs with %d workers" % workers)
+            
+            total = 0.0
+            for i in range(runs):
+                total += timed(LyxDocument.parse_parallel, text, workers)
+            
+            print 'Parse of %d KB, %2d processes: %.3fs, %.2fx' % \
+                (len(text) // 1024, workers, total / runs, serial / total)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+def bench_chapters(lyx_file, max_workers=4, runs=3):
+    """
+    Compare rendering the ePub chapters with 1 to max_workers processes
+    """
+    
+    lyx = LyxDocument.LyxDocument()
+    lyx.parse(lyx_file)
+    
+    folder = tempfile.mkdtemp()
+    try:
+        for workers in range(1, max_workers + 1):
+            epub = EpubDocument.EpubDocument()
+            epub.convert_from(lyx)
+            epub.set_file(os.path.join(folder, 'bench.epub'))
+            epub.chapter_workers = workers
+            
+            total = 0.0
+            for i in range(runs):
+                total += timed(epub.save)
+            
+            print 'ePub with %2d chapter workers: %.3fs per file' % (workers, total / runs)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+def render_chapter_dom(job):
+    """
+    Render a chapter to XHTML by building it as a DOM document, to check
+    EpubDocument.render_chapter() against
+    """
+    
+    template_folder, chapter, num, images = job
+    
+    doc = templates.parse(template_folder + '/OPS/chapter.xhtml')
+    
+    e = doc.getElementsByTagName('div')[0]
+    
+    if chapter.title is not None:
+        xml = parseString('<div class="chapter"><h2><span class="chapterHeader"><span class="translation">' +
+                          'Chapter</span> <span class="count">' + str(num) + '</span><br /><span class="chapterTitle">' +
+                          chapter.title + '</span></span></h2><br /></div>')
+        header = doc.importNode(xml.firstChild, True)
+        e.appendChild(header)
+    
+    div = doc.createElement('div')
+    e.appendChild(div)
+    
+    for paragraph in chapter.paragraphs:
+        p = doc.createElement('p')
+        start = 0
+        for offset, path in paragraph.images or []:
+            if paragraph.text[start:offset]:
+                p.appendChild(doc.createTextNode(paragraph.text[start:offset]))
+            if images is not None and images.get(path) is not None:
+                img = doc.createElement('img')
+                img.setAttribute('src', images[path])
+                img.setAttribute('alt', '')
+                p.appendChild(img)
+            start = offset
+        if paragraph.text[start:] or not p.childNodes:
+            p.appendChild(doc.createTextNode(paragraph.text[start:]))
+        div.appendChild(p)
+    
+    return doc.toxml('utf-8')
+
+def bench_serializer(lyx_file, runs=3):
+    """
+    Check the streaming chapter serializer gives the same XHTML as the
+    DOM one, and compare their speed
+    """
+    
+    lyx = LyxDocument.LyxDocument()
+    lyx.parse(lyx_file)
+    
+    chapters = list(lyx.chapters)
+    
+    # Markup characters, non-ASCII text, empty paragraphs and chapters
+    edge = Chapter(u'Edge cases')
+    for text in [u'', u'Fish & chips <b>"quoted"</b> > here', u'Caf\xe9 na\xefve \u2014 \u4e2d\u6587']:
+        edge.add_paragraph(text)
+    chapters.append(edge)
+    chapters.append(Chapter(u'Empty'))
+    
+    # The continuation of a split chapter has no header
+    continued = Chapter(None)
+    continued.paragraphs = edge.paragraphs
+    chapters.append(continued)
+    
+    # Graphics within, around and missing from a paragraph
+    pictures = Chapter(u'Pictures')
+    pictures.add_paragraph(u'Before & after', [(0, 'a.png'), (7, 'a&b.png'), (14, 'missing.png')])
+    pictures.add_paragraph(u'', [(0, 'missing.png')])
+    chapters.append(pictures)
+    images = {'a.png': 'images/a.png', 'a&b.png': 'images/a&b.png', 'missing.png': None}
+    
+    jobs = [('template', chapter, counter + 1, chapter is pictures and images or None)
+            for counter, chapter in enumerate(chapters)]
+    
+    # Graphics are left out without the paths of the stored pictures
+    jobs.append(('template', pictures, len(jobs) + 1, None))
+    
+    for job in jobs:
+        if EpubDocument.render_chapter(job) != render_chapter_dom(job):
+            raise AssertionError("Serializers differ on chapter %d: %s" % (job[2], job[1].title))
+    
+    for name, render in [('DOM', render_chapter_dom),
+                         ('streaming', EpubDocument.render_chapter)]:
+        total = 0.0
+        for i in range(runs):
+            total += timed(map, render, jobs)
+        
+        print 'Chapters rendered by %-11s %.4fs per file' % (name + ':', total / runs)
+    
+    return
+
+# Namespaces of the OPF metadata
+dc_namespace = 'http://purl.org/dc/elements/1.1/'
+opf_namespace = 'http://www.idpf.org/2007/opf'
+
+def render_package_dom(epub):
+    """
+    Return the OPF package file of an ePub document built as a DOM
+    document, to check EpubDocument.render_package() against
+    """
+    
+    doc = templates.parse(epub.template_folder + '/OPS/book.opf')
+    
+    identifier = doc.getElementsByTagNameNS(dc_namespace, 'identifier')[0]
+    identifier.appendChild(doc.createTextNode(epub.identifier))
+    
+    title = doc.getElementsByTagNameNS(dc_namespace, 'title')[0]
+    title.appendChild(doc.createTextNode(epub.title))
+    
+    creator = doc.getElementsByTagNameNS(dc_namespace, 'creator')[0]
+    creator.setAttributeNS(opf_namespace, 'opf:file-as', epub.author)
+    creator.appendChild(doc.createTextNode(epub.author))
+    
+    manifest = doc.getElementsByTagName('manifest')[0]
+    spine = doc.getElementsByTagName('spine')[0]
+    for part in epub.spine:
+        item = doc.createElement('item')
+        item.setAttribute('id', 'chapter' + part)
+        item.setAttribute('href', 'chapter' + part + '.xhtml')
+        item.setAttribute('media-type', 'application/xhtml+xml')
+        manifest.appendChild(item)
+        
+        itemref = doc.createElement('itemref')
+        itemref.setAttribute('idref', 'chapter' + part)
+        itemref.setAttribute('linear', 'yes')
+        spine.appendChild(itemref)
+    
+    for counter, (name, media_type) in enumerate(epub.images):
+        item = doc.createElement('item')
+        item.setAttribute('id', 'image%d' % (counter + 1))
+        item.setAttribute('href', name)
+        item.setAttribute('media-type', media_type)
+        manifest.appendChild(item)
+    
+    item = doc.createElement('item')
+    item.setAttribute('id', 'main-style')
+    item.setAttribute('href', 'css/style.css')
+    item.setAttribute('media-type', 'text/cs')
+    manifest.appendChild(item)
+    
+    item = doc.createElement('item')
+    item.setAttribute('id', 'ncx')
+    item.setAttribute('href', 'book.ncx')
+    item.setAttribute('media-type', 'application/x-dtbncx+xml')
+    manifest.appendChild(item)
+    
+    return doc.toxml('utf-8')
+
+def render_navigation_dom(epub):
+    """
+    Return the NCX navigation file of an ePub document built as a DOM
+    document, to check EpubDocument.render_navigation() against
+    """
+    
+    doc = templates.parse(epub.template_folder + '/OPS/book.ncx')
+    
+    meta = doc.getElementsByTagName('meta')
+    for m in meta:
+        if m.getAttribute('name') == 'dtb:uid':
+            m.setAttribute('content', epub.identifier)
+    
+    docTitle = doc.getElementsByTagName('docTitle')[0]
+    text = doc.createElement('text')
+    text.appendChild(doc.createTextNode(epub.title))
+    docTitle.appendChild(text)
+    
+    docAuthor = doc.getElementsByTagName('docAuthor')[0]
+    text = doc.createElement('text')
+    text.appendChild(doc.createTextNode(epub.author))
+    docAuthor.appendChild(text)
+    
+    navMap = doc.getElementsByTagName('navMap')[0]
+    for ch_num in epub.toc:
+        navPoint = doc.createElement('navPoint')
+        navPoint.setAttribute('class', 'chapter')
+        navPoint.setAttribute('id', ch_num)
+        navPoint.setAttribute('playOrder', ch_num)
+        navMap.appendChild(navPoint)
+        
+        navLabel = doc.createElement('navLabel')
+        text = doc.createElement('text')
+        text.appendChild(doc.createTextNode('Chapter ' + ch_num))
+        navLabel.appendChild(text)
+        navPoint.appendChild(navLabel)
+        
+        content = doc.createElement('content')
+        content.setAttribute('src', 'chapter' + ch_num + '.xhtml')
+        navPoint.appendChild(content)
+    
+    return doc.toxml('utf-8')
+
+def bench_package(chapters=5000, runs=3):
+    """
+    Check the OPF and NCX files written from the split templates are the
+    same as the DOM ones, and compare their speed on a book of many
+    chapters
+    """
+    
+    epub = EpubDocument.EpubDocument()
+    
+    # Markup and non-ASCII characters, an empty book, split chapters and
+    # graphics
+    epub.title = u'Fish & chips <"quoted"> \u4e2d\u6587'
+    epub.author = u'Caf\xe9 & co'
+    epub.identifier = 'Book_<&>'
+    for spine, toc, images in [([], [], []),
+                               (['1', '2', '2-2', '3'], ['1', '2', '3'], [('images/a.png', 'image/png')])]:
+        epub.spine, epub.toc, epub.images = spine, toc, images
+        if epub.render_package() != render_package_dom(epub):
+            raise AssertionError("OPF files differ with %d chapter files" % len(spine))
+        if epub.render_navigation() != render_navigation_dom(epub):
+            raise AssertionError("NCX files differ with %d chapters" % len(toc))
+    
+    epub.toc = [str(counter + 1) for counter in range(chapters)]
+    epub.spine = epub.toc
+    epub.images = []
+    
+    if epub.render_package() != render_package_dom(epub) or \
+            epub.render_navigation() != render_navigation_dom(epub):
+        raise AssertionError("OPF or NCX files differ with %d chapters" % chapters)
+    
+    for name, package, navigation in [('DOM', render_package_dom, render_navigation_dom),
+                                      ('templates', EpubDocument.EpubDocument.render_package,
+                                       EpubDocument.EpubDocument.render_navigation)]:
+        total = 0.0
+        for i in range(runs):
+            total += timed(package, epub) + timed(navigation, epub)
+        
+        print 'OPF and NCX of %d chapters by %-10s %.4fs' % (chapters, name + ':', total / runs)
+    
+    return
+
+def bench_templates(lyx_file, runs=3):
+    """
+    Compare saving the ePub with an empty template cache against saving
+    it with the templates already cached
+    """
+    
+    lyx = LyxDocument.LyxDocument()
+    lyx.parse(lyx_file)
+    
+    folder = tempfile.mkdtemp()
+    try:
+        epub = EpubDocument.EpubDocument()
+        epub.convert_from(lyx)
+        epub.set_file(os.path.join(folder, 'bench.epub'))
+        
+        for cached in [False, True]:
+            total = 0.0
+            hits = templates.hits
+            loads = templates.loads
+            for i in range(runs):
+                if not cached:
+                    templates.clear()
+                total += timed(epub.save)
+            
+            print 'ePub with %-17s %.4fs per file, %d template loads, %d cache hits' % \
+                (cached and 'cached templates:' or 'template loading:', total / runs,
+                 templates.loads - loads, templates.hits - hits)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+def write_include_corpus(folder, masters, children, per_master):
+    """
+    Write master LyX files sharing child documents, each child including
+    a common preface, and return the master file names
+    """
+    
+    def write(path, body):
+        f = open(path, 'w')
+        f.write('\\lyxformat 345\n\\begin_document\n\\begin_header\n\\end_header\n\n' +
+                '\\begin_body\n' + body + '\n\\end_body\n\\end_document\n')
+        f.close()
+    
+    def include(name):
+        return ('\\begin_layout Standard\n\\begin_inset CommandInset include\n' +
+                'LatexCommand include\nfilename "%s"\n\n\\end_inset\n\n\n\\end_layout\n' % name)
+    
+    paragraph = '\\begin_layout Standard\n' + 'Lorem ipsum dolor sit amet.\n' * 20 + '\\end_layout\n\n'
+    
+    os.mkdir(os.path.join(folder, 'parts'))
+    write(os.path.join(folder, 'parts', 'preface.lyx'), paragraph)
+    for i in range(children):
+        write(os.path.join(folder, 'parts', 'child %d.lyx' % i),
+              include('preface.lyx') + '\\begin_layout Chapter\nChapter %d\n\\end_layout\n\n' % i + paragraph * 50)
+    
+    files = []
+    for i in range(masters):
+        path = os.path.join(folder, 'master %d.lyx' % i)
+        write(path, ''.join([include('parts/child %d.lyx' % ((i + j) % children))
+                             for j in range(per_master)]))
+        files.append(path)
+    
+    return files
+
+def bench_includes(masters=200, children=40, per_master=10):
+    """
+    Compare resolving the includes of a corpus of master files with and
+    without the child documents cached, and with concurrent reads
+    """
+    
+    folder = tempfile.mkdtemp()
+    try:
+        files = write_include_corpus(folder, masters, children, per_master)
+        texts = []
+        for path in files:
+            f = open(path, 'r')
+            texts.append((f.read(), path))
+            f.close()
+        
+        for name, workers, shared in [('uncached, serial', 1, False),
+                                      ('uncached, 4 threads', 4, False),
+                                      ('cached', 1, True)]:
+            resolver = IncludeResolver(workers)
+            start = time.time()
+            for text, path in texts:
+                if not shared:
+                    resolver.bodies = {}
+                    resolver.resolved = {}
+                resolver.resolve(text, path)
+            elapsed = time.time() - start
+            resolver.close()
+            
+            print 'Includes %-20s %.3fs for %d masters, %d child reads' % \
+                (name + ':', elapsed, masters, resolver.loads)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+class DictChapter(object):
+    """
+    Chapter as it was before __slots__, for comparison
+    """
+    
+    def __init__(self, title):
+        self.title = title
+        self.paragraphs = []
+    
+    def add_paragraph(self, text):
+        self.paragraphs.append(DictParagraph(text))
+
+class DictParagraph(object):
+    
+    def __init__(self, text):
+        self.text = text
+
+def model_size(chapters):
+    """
+    Return the bytes taken by the chapter and paragraph objects, leaving
+    out the text they share
+    """
+    
+    def size(obj):
+        total = sys.getsizeof(obj)
+        if hasattr(obj, '__dict__'):
+            total += sys.getsizeof(obj.__dict__)
+        return total
+    
+    total = 0
+    for chapter in chapters:
+        total += size(chapter) + sys.getsizeof(chapter.paragraphs)
+        for paragraph in chapter.paragraphs:
+            total += size(paragraph)
+    
+    return total
+
+def concat_standard(content):
+    """
+    process_standard as it was before joining the pieces, for comparison
+    """
+    
+    text = ""
+    for element in content:
+        if type(element) is unicode or type(element) is str:
+            if element != 'begin_layout Standard':
+                text += element
+    
+    return text
+
+def bench_model(chapters=50, paragraphs=1000, pieces=2000, runs=3):
+    """
+    Compare the memory of the document model with and without __slots__
+    for a large book, and the speed of building paragraph text by
+    concatenation and by joining
+    """
+    
+    texts = [u'Paragraph %d of the chapter.' % i for i in range(paragraphs)]
+    
+    for name, chapter_class in [('__dict__', DictChapter), ('__slots__', Chapter)]:
+        book = []
+        start = time.time()
+        for c in range(chapters):
+            chapter = chapter_class(u'Chapter %d' % c)
+            for text in texts:
+                chapter.add_paragraph(text)
+            book.append(chapter)
+        elapsed = time.time() - start
+        
+        print 'Model with %-10s %6.1f MB for %d paragraphs, built in %.3fs' % \
+            (name + ':', model_size(book) / 1048576.0, chapters * paragraphs, elapsed)
+    
+    content = [u'begin_layout Standard'] + [u' Lorem ipsum dolor sit amet,'] * pieces + [[u'begin_inset Quotes eld']]
+    if concat_standard(content) != LyxDocument.LyxDocument().process_standard(content):
+        raise AssertionError("Joined paragraph text differs from concatenated")
+    
+    for name, function in [('concatenated', concat_standard),
+                           ('joined', LyxDocument.LyxDocument().process_standard)]:
+        total = 0.0
+        for i in range(runs):
+            total += timed(function, content)
+        
+        print 'Paragraph text %-13s %.4fs for %d pieces' % (name + ':', total / runs, pieces)
+    
+    return
+
+def bench_archive(max_workers=4, chapters=40, paragraphs=300, runs=3):
+    """
+    Compare writing the ePub archive of a large book with its entries
+    compressed by 1 to max_workers threads, and at a fast level
+    """
+    
+    rand = random.Random(0)
+    words = lyxcorpus.words
+    book = []
+    for c in range(chapters):
+        chapter = Chapter(u'Chapter %d' % c)
+        for p in range(paragraphs):
+            chapter.add_paragraph(u' '.join([rand.choice(words) for i in range(100)]))
+        book.append(chapter)
+    
+    parts = [EpubDocument.render_chapter(('template', chapter, counter + 1, None))
+             for counter, chapter in enumerate(book)]
+    
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'bench.epub')
+        
+        def write(level, workers):
+            archive = EpubArchive(path, level, workers)
+            for counter, data in enumerate(parts):
+                info = zipfile.ZipInfo('OPS/chapter%d.xhtml' % (counter + 1))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.add(info, data)
+            archive.close()
+        
+        write(-1, 1)
+        reference = zipfile.ZipFile(path).read('OPS/chapter1.xhtml')
+        
+        for level in [-1, 1]:
+            for workers in range(1, max_workers + 1):
+                total = 0.0
+                for i in range(runs):
+                    total += timed(write, level, workers)
+                
+                archive = zipfile.ZipFile(path)
+                if archive.testzip() is not None or archive.read('OPS/chapter1.xhtml') != reference:
+                    raise AssertionError("Archive differs with %d threads at level %d" % (workers, level))
+                archive.close()
+                
+                print 'Archive of %.1f MB, level %2d, %d threads: %.3fs, %.1f MB' % \
+                    (sum(map(len, parts)) / 1048576.0, level, workers, total / runs,
+                     os.path.getsize(path) / 1048576.0)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+def bench_cache(lyx_file, runs=5):
+    """
+    Compare converting a LyX file to every format with restoring the
+    files from the output cache
+    """
+    
+    formats = sorted(lyx2ebook.writers)
+    folder = tempfile.mkdtemp()
+    try:
+        cache = OutputCache(folder)
+        
+        # A converted book is identified by its content, so converting it
+        # again gives the same package
+        opf = []
+        for i in range(2):
+            lyx2ebook.lyx2ebook(lyx_file, ['epub'])
+            opf.append(zipfile.ZipFile(output_file(lyx_file, 'epub')).read('OPS/book.opf'))
+        if opf[0] != opf[1]:
+            raise AssertionError("The ePub identifier is not derived from the content")
+        
+        converted = timed(lyx2ebook.lyx2ebook, lyx_file, formats, False, None, cache)
+        outputs = [open(output_file(lyx_file, format), 'rb').read() for format in formats]
+        
+        total = 0.0
+        for i in range(runs):
+            total += timed(lyx2ebook.lyx2ebook, lyx_file, formats, False, None, cache)
+        
+        if cache.hits != runs * len(formats):
+            raise AssertionError("The output cache missed unchanged files")
+        if outputs != [open(output_file(lyx_file, format), 'rb').read() for format in formats]:
+            raise AssertionError("Restored files differ from the converted ones")
+        
+        print 'Convert to %s: %.3fs, restored from the cache: %.4fs' % \
+            (', '.join(formats), converted, total / runs)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+def bench_graphics(chapters=40, pictures=5, picture_size=2097152, runs=3):
+    """
+    Time saving a book whose chapters each show every picture, some
+    files being copies of others, and check each content is stored once
+    """
+    
+    folder = tempfile.mkdtemp()
+    try:
+        rand = random.Random(0)
+        paths = []
+        for i in range(pictures):
+            data = ''.join([chr(rand.randint(0, 255)) for j in range(4096)]) * (picture_size / 4096)
+            for copy in ['', '-copy']:
+                path = os.path.join(folder, 'picture%d%s.jpg' % (i, copy))
+                f = open(path, 'wb')
+                f.write(data)
+                f.close()
+                paths.append(path)
+        
+        book = []
+        for c in range(chapters):
+            chapter = Chapter(u'Chapter %d' % c)
+            chapter.add_paragraph(u'Pictures', [(8, path) for path in paths])
+            book.append(chapter)
+        
+        epub = EpubDocument.EpubDocument()
+        epub.set_file(os.path.join(folder, 'bench.epub'))
+        epub.chapters = book
+        
+        total = 0.0
+        for i in range(runs):
+            total += timed(epub.save)
+        
+        # The pictures are read while the chapters are rendered, but only
+        # written by the thread writing the chapters
+        epub.chapter_workers = 4
+        epub.save()
+        
+        archive = zipfile.ZipFile(epub.file_name)
+        stored = [info for info in archive.infolist() if info.filename.startswith('OPS/images/')]
+        if len(stored) != pictures or len(epub.images) != pictures:
+            raise AssertionError("%d pictures stored instead of %d" % (len(stored), pictures))
+        for info in stored:
+            if info.compress_type != zipfile.ZIP_STORED or info.file_size != picture_size:
+                raise AssertionError("Picture not stored whole: " + info.filename)
+        if archive.testzip() is not None:
+            raise AssertionError("Corrupt picture archive")
+        archive.close()
+        
+        print 'Book of %d chapters showing %d pictures of %.1f MB, %d distinct: %.3fs' % \
+            (chapters, len(paths), picture_size / 1048576.0, pictures, total / runs)
+    finally:
+        shutil.rmtree(folder)
+    
+    return
+
+def bench_startup(lyx_file, runs=5):
+    """
+    Check the scripts start without loading the parser, and time running
+    them for --help and for short conversions
+    """
+    
+    devnull = open(os.devnull, 'w')
+    
+    def run(*args):
+        if subprocess.call([sys.executable] + list(args), stdout=devnull, stderr=devnull) != 0:
+            raise AssertionError("Failed: " + " ".join(args))
+    
+    for script in ['lyx2epub', 'lyx2rtf', 'lyx2txt', 'lyx2ebook', 'EpubDocument', 'RTFDocument', 'TextDocument']:
+        run('-c', 'import sys, %s\nif "lepl" in sys.modules: sys.exit(1)' % script)
+    
+    try:
+        for name, args in [('import lepl', ['-c', 'import lepl']),
+                           ('lyx2txt --help', ['lyx2txt.py', '--help']),
+                           ('lyx2epub --help', ['lyx2epub.py', '--help']),
+                           ('lyx2txt --stream', ['lyx2txt.py', '--stream', lyx_file]),
+                           ('lyx2txt', ['lyx2txt.py', lyx_file])]:
+            total = 0.0
+            for i in range(runs):
+                total += timed(run, *args)
+            
+            print 'Start-up %-20s %.3fs' % (name + ':', total / runs)
+    finally:
+        devnull.close()
+    
+    return
+
+if __name__ == '__main__':
+    """
+    Run the benchmarks against a LyX file.
+    
+    Usage: benchmark file.lyx [runs] [workers]
+    """
+    
+    configure_logging()
+    
+    # Keep the per-file log lines out of the timings
+    logger.setLevel(logging.ERROR)
+    logging.getLogger().setLevel(logging.ERROR)
+    
+    runs = 5
+    if len(sys.argv) > 2:
+        runs = int(sys.argv[2])
+    
+    workers = multiprocessing.cpu_count()
+    if len(sys.argv) > 3:
+        workers = int(sys.argv[3])
+    
+    bench_startup(sys.argv[1], runs)
+    bench_grammar(sys.argv[1], runs)
+    bench_lexer(runs=runs)
+    bench_parse(workers, runs=runs)
+    bench_model(runs=runs)
+    bench_includes()
+    bench_serializer(sys.argv[1], runs)
+    bench_templates(sys.argv[1], runs)
+    bench_package(runs=runs)
+    bench_chapters(sys.argv[1], workers, runs)
+    bench_archive(workers, runs=runs)
+    bench_graphics(runs=runs)
+    bench_cache(sys.argv[1], runs)
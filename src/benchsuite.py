@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+    End-to-end benchmarks over synthetic LyX documents.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import subprocess
+import logging
+from optparse import OptionParser
+
+import LyxDocument
+import EpubDocument
+import RTFDocument
+import TextDocument
+from IncludeResolver import includes
+from lyxcorpus import write_corpus
+from LogConfig import configure_logging
+
+logger = logging.getLogger('lyx2ebook')
+
+# Corpus parameters of each case:
+# (name, chapters, paragraphs, words per paragraph, include depth, inset density)
+cases = [
+    ('small', 4, 10, 40, 0, 0.0),
+    ('includes', 4, 10, 40, 3, 0.0),
+    ('insets', 4, 10, 40, 1, 0.05),
+    ('medium', 10, 20, 60, 1, 0.02),
+]
+
+writers = [
+    ('epub', EpubDocument.EpubDocument),
+    ('rtf', RTFDocument.RTFDocument),
+    ('txt', TextDocument.TextDocument),
+]
+
+def measure(function, runs):
+    """
+    Call function runs times and return the best and median wall times
+    """
+    
+    times = []
+    for i in range(runs):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    times.sort()
+    
+    return {'best': times[0], 'median': times[len(times) // 2]}
+
+def revision():
+    """
+    Return the git commit of the working tree, or None outside git
+    """
+    
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0].strip()
+    except OSError:
+        return None
+    
+    return process.returncode == 0 and output or None
+
+def run_case(folder, case, runs):
+    """
+    Write the corpus of a case and time parsing, processing the parse
+    tree and saving each format
+    """
+    
+    name, chapters, paragraphs, length, depth, inset_density = case
+    master = write_corpus(os.path.join(folder, name), chapters, paragraphs, length,
+                          depth, inset_density)
+    
+    preprocessed, size = includes.read(master)
+    tree = LyxDocument.parse_string(preprocessed)
+    
+    def parse():
+        LyxDocument.LyxDocument().parse(master)
+    
+    def process_root():
+        LyxDocument.LyxDocument().process_root(tree)
+    
+    timings = {
+        'parse': measure(parse, runs),
+        'process_root': measure(process_root, runs),
+    }
+    
+    lyx = LyxDocument.LyxDocument()
+    lyx.parse(master)
+    
+    sizes = {
+        'input_bytes': size,
+        'chapters': len(lyx.chapters),
+        'paragraphs': sum([len(chapter.paragraphs) for chapter in lyx.chapters]),
+    }
+    
+    for format, writer in writers:
+        ebook = writer()
+        ebook.convert_from(lyx)
+        timings['save_' + format] = measure(ebook.save, runs)
+        sizes[format + '_bytes'] = os.path.getsize(ebook.file_name)
+    
+    return {
+        'corpus': {'chapters': chapters, 'paragraphs': paragraphs, 'length': length,
+                   'depth': depth, 'inset_density': inset_density},
+        'sizes': sizes,
+        'timings': timings,
+    }
+
+def run_suite(runs=3, names=None):
+    """
+    Run the benchmark cases, all of them unless names are given, and
+    return the results as a dictionary ready to be written as JSON
+    """
+    
+    # Keep grammar compilation out of the first timing
+    LyxDocument.get_parser()
+    
+    results = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'runs': runs,
+        'cases': {},
+    }
+    
+    folder = tempfile.mkdtemp()
+    try:
+        for case in cases:
+            if names is None or case[0] in names:
+                results['cases'][case[0]] = run_case(folder, case, runs)
+    finally:
+        shutil.rmtree(folder)
+    
+    return results
+
+def compare(old, new, threshold=0.1, noise=0.001):
+    """
+    Print the change of each median timing between two results and
+    return the number of timings slower by more than threshold, ignoring
+    differences under noise seconds
+    """
+    
+    regressions = 0
+    for name in sorted(new['cases']):
+        if name not in old['cases']:
+            continue
+        for stage in sorted(new['cases'][name]['timings']):
+            if stage not in old['cases'][name]['timings']:
+                continue
+            before = old['cases'][name]['timings'][stage]['median']
+            after = new['cases'][name]['timings'][stage]['median']
+            change = before and (after - before) / before or 0.0
+            flag = ''
+            if change > threshold and after - before > noise:
+                flag = '  REGRESSION'
+                regressions += 1
+            print '%-10s %-14s %8.4fs -> %8.4fs %+7.1f%%%s' % \
+                (name, stage, before, after, change * 100, flag)
+    
+    return regressions
+
+def load(path):
+    f = open(path, 'r')
+    results = json.load(f)
+    f.close()
+    
+    return results
+
+if __name__ == '__main__':
+    """
+    Run the benchmark suite and write the results as JSON, or compare
+    two results files.
+    
+    Usage: benchsuite [--runs N] [--case NAME] [--output results.json]
+           benchsuite --compare old.json new.json [--threshold 0.1]
+    """
+    
+    parser = OptionParser(usage="%prog [options]\n       %prog --compare old.json new.json")
+    parser.add_option("-r", "--runs", type="int", default=3,
+                      help="runs of each timing [default: %default]")
+    parser.add_option("-c", "--case", action="append", default=None,
+                      help="only run this case, may be repeated (%s)" %
+                      ", ".join([case[0] for case in cases]))
+    parser.add_option("-o", "--output", default=None,
+                      help="write the results to this file instead of standard output")
+    parser.add_option("--compare", action="store_true", default=False,
+                      help="compare two results files")
+    parser.add_option("-t", "--threshold", type="float", default=0.1,
+                      help="slowdown reported as a regression [default: %default]")
+    options, args = parser.parse_args()
+    
+    if options.compare:
+        if len(args) != 2:
+            parser.error("two results files are required")
+        if compare(load(args[0]), load(args[1]), options.threshold):
+            sys.exit(1)
+    else:
+        configure_logging()
+        
+        # Keep the per-file log lines out of the timings
+        logger.setLevel(logging.ERROR)
+        logging.getLogger().setLevel(logging.ERROR)
+        
+        results = json.dumps(run_suite(options.runs, options.case), indent=2, sort_keys=True)
+        if options.output is None:
+            print results
+        else:
+            f = open(options.output, 'w')
+            f.write(results + '\n')
+            f.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+    Compare conversion throughput of the conversion service and the CLI.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import urllib
+import httplib
+import zipfile
+import subprocess
+import multiprocessing.pool
+from StringIO import StringIO
+from optparse import OptionParser
+
+from IncludeResolver import includes
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+    
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+def connect(address):
+    """
+    Open a connection to a service address, either host:port or the
+    path of a Unix socket
+    """
+    
+    if ':' in address:
+        return httplib.HTTPConnection(address)
+    
+    return UnixHTTPConnection(address)
+
+def pack(lyx_file):
+    """
+    Return (body, content type, name) of a request converting lyx_file,
+    zipping it together with its child documents if it has any
+    """
+    
+    folder = os.path.dirname(lyx_file)
+    children = includes.dependencies(lyx_file)
+    name = os.path.basename(lyx_file)
+    
+    if not children:
+        f = open(lyx_file, 'rb')
+        body = f.read()
+        f.close()
+        return (body, 'application/x-lyx', name)
+    
+    data = StringIO()
+    archive = zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED)
+    archive.write(lyx_file, name)
+    for path in children:
+        archive.write(path, os.path.relpath(path, folder))
+    archive.close()
+    
+    return (data.getvalue(), 'application/zip', name)
+
+def request(address, body, content_type, name, format):
+    """
+    Convert a document with the service, returning the output
+    """
+    
+    connection = connect(address)
+    connection.request('POST', '/convert?format=%s&name=%s' % (urllib.quote(format), urllib.quote(name)), body,
+                       {'Content-Type': content_type})
+    response = connection.getresponse()
+    output = response.read()
+    connection.close()
+    
+    if response.status != 200:
+        raise RuntimeError("%d %s" % (response.status, output.strip()))
+    
+    return output
+
+def metrics(address):
+    connection = connect(address)
+    connection.request('GET', '/metrics')
+    report = json.loads(connection.getresponse().read())
+    connection.close()
+    
+    return report
+
+def run(task, requests, concurrency):
+    """
+    Run task requests times over concurrency threads, returning the
+    requests per second
+    """
+    
+    pool = multiprocessing.pool.ThreadPool(concurrency)
+    start = time.time()
+    pool.map(task, range(requests))
+    elapsed = time.time() - start
+    pool.close()
+    
+    return requests / elapsed
+
+def bench_service(address, lyx_file, format, requests, concurrency):
+    body, content_type, name = pack(lyx_file)
+    
+    return run(lambda i: request(address, body, content_type, name, format),
+               requests, concurrency)
+
+def bench_cli(lyx_file, format, requests, concurrency):
+    script = {'epub': 'lyx2epub.py', 'rtf': 'lyx2rtf.py', 'txt': 'lyx2txt.py'}[format]
+    devnull = open(os.devnull, 'w')
+    
+    def convert(i):
+        if subprocess.call([sys.executable, script, lyx_file],
+                           stdout=devnull, stderr=devnull) != 0:
+            raise RuntimeError(script + " failed")
+    
+    try:
+        return run(convert, requests, concurrency)
+    finally:
+        devnull.close()
+
+if __name__ == '__main__':
+    """
+    Send requests to a running lyx2ebookd and run the matching CLI
+    script the same number of times, printing the throughput of each.
+    
+    Usage: loadgen [options] file.lyx
+    """
+    
+    parser = OptionParser(usage="%prog [options] file.lyx")
+    parser.add_option("-a", "--address", default="127.0.0.1:8470",
+                      help="service host:port or Unix socket path [default: %default]")
+    parser.add_option("-f", "--format", default="epub",
+                      help="output format [default: %default]")
+    parser.add_option("-n", "--requests", type="int", default=20,
+                      help="number of conversions [default: %default]")
+    parser.add_option("-c", "--concurrency", type="int", default=multiprocessing.cpu_count(),
+                      help="conversions in flight at once [default: %default]")
+    parser.add_option("--no-cli", action="store_true", default=False,
+                      help="only measure the service")
+    options, args = parser.parse_args()
+    
+    if len(args) != 1:
+        parser.error("a LyX file is required")
+    
+    service = bench_service(options.address, args[0], options.format,
+                            options.requests, options.concurrency)
+    print 'service: %.2f conversions/s' % service
+    
+    report = metrics(options.address)
+    print 'service metrics:', json.dumps(report, sort_keys=True)
+    
+    if not options.no_cli:
+        cli = bench_cli(args[0], options.format, options.requests, options.concurrency)
+        print 'cli:     %.2f conversions/s' % cli
+        print 'speedup: %.2fx' % (service / cli)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+    Convert LyX file to several eBook formats at once.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import logging
+import threading
+import Queue
+from optparse import OptionParser
+
+import LyxDocument
+from LyxWatcher import LyxWatcher
+import EpubDocument
+import RTFDocument
+import TextDocument
+from OutputCache import OutputCache, output_file
+from ConversionMetrics import ConversionMetrics
+from LogConfig import configure_logging
+
+logger = logging.getLogger('lyx2ebook')
+
+# eBook document class for each output format
+writers = {
+    'epub': EpubDocument.EpubDocument,
+    'rtf': RTFDocument.RTFDocument,
+    'txt': TextDocument.TextDocument,
+}
+
+class ChapterFeed(object):
+    """
+    Chapters handed from the thread reading a streamed document to one
+    writer thread, holding at most size of them at a time
+    """
+    
+    def __init__(self, size=4):
+        self.queue = Queue.Queue(size)
+        self.ended = False
+    
+    def put(self, chapter):
+        self.queue.put(chapter)
+    
+    def end(self):
+        self.queue.put(None)
+    
+    def __iter__(self):
+        while not self.ended:
+            chapter = self.queue.get()
+            if chapter is None:
+                self.ended = True
+            else:
+                yield chapter
+    
+    def drain(self):
+        for chapter in self:
+            pass
+
+def save(ebook, errors, feed=None):
+    try:
+        ebook.save()
+    except Exception, e:
+        logger.exception("Failed to save " + ebook.file_name)
+        errors.append(e)
+        
+        # Keep taking chapters so the reading thread is not blocked
+        if feed is not None:
+            feed.drain()
+
+def lyx2ebook(lyx_file, formats, stream=False, metrics=None, cache=None, jobs=1):
+    """
+    Convert Lyx file to each of the formats, parsing it only once and
+    saving the eBook documents in parallel threads. A streamed document
+    is handed to the writers a few chapters at a time.
+    
+    Record the stages of the conversion in metrics, a ConversionMetrics,
+    if given. With an OutputCache, the formats whose files it holds for
+    the unchanged document are restored, and only the others converted.
+    
+    The chapters are parsed over jobs processes when there are more than
+    one.
+    """
+    
+    keys = {}
+    if cache is not None:
+        for format in formats:
+            keys[format] = cache.key(lyx_file, format)
+        formats = [format for format in formats
+                   if not cache.restore(keys[format], output_file(lyx_file, format))]
+        if not formats:
+            return
+    
+    lyx = LyxDocument.LyxDocument()
+    lyx.metrics = metrics
+    lyx.parse_workers = jobs
+    if stream:
+        lyx.parse_stream(lyx_file)
+    else:
+        lyx.parse(lyx_file)
+    
+    logger.info("Title: " + lyx.title)
+    logger.info("Author: " + lyx.author)
+    
+    errors = []
+    threads = []
+    feeds = []
+    ebooks = []
+    for format in formats:
+        ebook = writers[format]()
+        ebook.convert_from(lyx)
+        ebooks.append(ebook)
+        
+        # A streamed document can only be read once, so each writer is
+        # handed the chapters as they are read
+        feed = None
+        if stream and len(formats) > 1:
+            feed = ebook.chapters = ChapterFeed()
+            feeds.append(feed)
+        
+        thread = threading.Thread(target=save, args=(ebook, errors, feed))
+        thread.start()
+        threads.append(thread)
+    
+    try:
+        if feeds:
+            for chapter in lyx.chapters:
+                for feed in feeds:
+                    feed.put(chapter)
+    finally:
+        for feed in feeds:
+            feed.end()
+        
+        for thread in threads:
+            thread.join()
+    
+    if errors:
+        raise errors[0]
+    
+    if cache is not None:
+        for format, ebook in zip(formats, ebooks):
+            cache.store(keys[format], ebook.file_name)
+    
+    return
+
+def parse_formats(value):
+    """
+    Split a comma separated list of formats, checking each one is known
+    """
+    
+    formats = [format.strip() for format in value.split(',') if format.strip()]
+    for format in formats:
+        if format not in writers:
+            raise ValueError("unknown format '%s'" % format)
+    
+    return formats
+
+if __name__ == '__main__':
+    """
+    Convert Lyx file to ePub, RTF and text files.
+    
+    Usage: lyx2ebook [--format epub,rtf,txt] [--stream] [--jobs N] [--watch]
+                     [--metrics FILE] [--cache DIR] [--cache-size MB] file.lyx
+    """
+    
+    parser = OptionParser(usage="%prog [options] file.lyx")
+    parser.add_option("-f", "--format", default="epub,rtf,txt",
+                      help="comma separated output formats [default: %default]")
+    parser.add_option("-s", "--stream", action="store_true", default=False,
+                      help="read the LyX file line by line")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="number of processes parsing chapters [default: %default]")
+    parser.add_option("-w", "--watch", action="store_true", default=False,
+                      help="keep running and reconvert whenever the document changes")
+    parser.add_option("-m", "--metrics", default=None, metavar="FILE",
+                      help="write the time and memory of each stage as JSON to FILE, - for standard error")
+    parser.add_option("-c", "--cache", default=None, metavar="DIR",
+                      help="reuse the eBook files of unchanged documents kept in DIR")
+    parser.add_option("--cache-size", type="int", default=200, metavar="MB",
+                      help="size the cache is kept within [default: %default]")
+    options, args = parser.parse_args()
+    
+    if len(args) != 1:
+        parser.error("a LyX file is required")
+    
+    try:
+        formats = parse_formats(options.format)
+    except ValueError, e:
+        parser.error(str(e))
+    
+    if options.watch and options.metrics:
+        parser.error("--metrics cannot be used with --watch")
+    
+    configure_logging()
+    
+    cache = None
+    if options.cache:
+        cache = OutputCache(options.cache, options.cache_size * 1048576)
+    
+    if options.watch:
+        watcher = LyxWatcher(args[0], formats,
+                             lambda changed: lyx2ebook(args[0], changed, options.stream,
+                                                       None, cache, options.jobs))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        print 'Converting', args[0]
+        
+        metrics = None
+        if options.metrics:
+            metrics = ConversionMetrics()
+        
+        # Process Lyx file
+        lyx2ebook(args[0], formats, options.stream, metrics, cache, options.jobs)
+        
+        print 'Converted'
+        
+        if metrics is not None:
+            metrics.write(options.metrics)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+    Conversion service keeping warm worker processes.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import time
+import json
+import shutil
+import zipfile
+import logging
+import tempfile
+import threading
+import cgi
+import urlparse
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+from optparse import OptionParser
+
+import LyxDocument
+import lyx2ebook
+from lyxbatch import init_worker
+from OutputCache import OutputCache, output_file
+from IncludeResolver import includes, child_names, graphics, map_file
+from LogConfig import configure_logging
+
+logger = logging.getLogger('lyx2ebook')
+
+# Content type returned for each output format
+content_types = {
+    'epub': 'application/epub+zip',
+    'rtf': 'application/rtf',
+    'txt': 'text/plain; charset=utf-8',
+}
+
+def checked_name(name):
+    """
+    Return the file name of a request normalised, raising ValueError if it
+    is absolute or outside the folder the request is written to
+    """
+    
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path in ('.', '..') or path.startswith('..' + os.sep):
+        raise ValueError("Bad file name: " + name)
+    
+    return path
+
+def check_inputs(folder, master):
+    """
+    Raise ValueError if the LyX file master, or a child document it
+    includes, includes a child document or shows graphics outside folder.
+    
+    Each name is checked before the file it names is read.
+    """
+    
+    files = [master]
+    checked = set()
+    while files:
+        file = files.pop()
+        if file in checked:
+            continue
+        checked.add(file)
+        
+        base = os.path.dirname(file)
+        names, pictures = map_file(file, lambda data: (child_names(data), graphics(data, base)))
+        children = [os.path.join(base, name) for name in names]
+        for path in children + pictures:
+            checked_name(os.path.relpath(path, folder))
+        files.extend(children)
+    
+    return
+
+def convert(job):
+    """
+    Convert a LyX document in a worker process.
+    
+    job is (files, master, format, cache), files mapping relative file
+    names to their contents, and cache an OutputCache or None. Return
+    (output or None, error or None, start, end).
+    
+    Names outside the request's folder fail the conversion, as do child
+    documents and graphics outside it.
+    """
+    
+    files, master, format, cache = job
+    
+    start = time.time()
+    folder = tempfile.mkdtemp()
+    try:
+        for name, data in files.items():
+            path = os.path.join(folder, checked_name(name))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(path, 'wb')
+            f.write(data)
+            f.close()
+        
+        path = os.path.join(folder, checked_name(master))
+        check_inputs(folder, path)
+        
+        # The cache keys on the file names relative to the master, so it
+        # is shared by every request whatever folder it is written to
+        key = None
+        if cache is not None:
+            key = cache.key(path, format)
+        
+        if key is None or not cache.restore(key, output_file(path, format)):
+            lyx = LyxDocument.LyxDocument()
+            lyx.parse(path)
+            
+            ebook = lyx2ebook.writers[format]()
+            ebook.convert_from(lyx)
+            ebook.save()
+            
+            if cache is not None:
+                cache.store(key, ebook.file_name)
+        
+        f = open(output_file(path, format), 'rb')
+        output = f.read()
+        f.close()
+        
+        error = None
+    except Exception, e:
+        output = None
+        error = '%s: %s' % (e.__class__.__name__, str(e).split('\n')[0])
+    shutil.rmtree(folder, True)
+    
+    # Each request is in a folder of its own, so its child documents are
+    # never read again
+    includes.clear()
+    
+    return (output, error, start, time.time())
+
+class Metrics(object):
+    
+    def __init__(self, workers):
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.started = time.time()
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.busy = 0.0
+        # Latencies of the most recent requests, in seconds
+        self.latencies = collections.deque(maxlen=1000)
+    
+    def begin(self):
+        self.lock.acquire()
+        self.in_flight += 1
+        self.lock.release()
+    
+    def end(self, latency, busy, failed):
+        self.lock.acquire()
+        self.in_flight -= 1
+        self.requests += 1
+        if failed:
+            self.failures += 1
+        self.busy += busy
+        self.latencies.append(latency)
+        self.lock.release()
+    
+    def report(self):
+        self.lock.acquire()
+        latencies = sorted(self.latencies)
+        uptime = time.time() - self.started
+        report = {
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'queue_depth': max(0, self.in_flight - self.workers),
+            'requests': self.requests,
+            'failures': self.failures,
+            'uptime': uptime,
+            'utilisation': self.busy / (self.workers * uptime),
+        }
+        self.lock.release()
+        
+        if latencies:
+            report['latency'] = {
+                'mean': sum(latencies) / len(latencies),
+                'p50': latencies[len(latencies) / 2],
+                'p95': latencies[int(len(latencies) * 0.95)],
+                'max': latencies[-1],
+            }
+        
+        return report
+
+class ConversionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /convert?format=epub&name=book.lyx with the LyX file as the body,
+    or with a zip of the master and its child documents as the body and
+    the master's name in the zip as name. GET /metrics for the metrics.
+    """
+    
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address and self.client_address[0] or 'local')
+    
+    def log_message(self, format, *args):
+        logger.debug(self.address_string() + ' ' + format % args)
+    
+    def _reply(self, code, content_type, data):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_GET(self):
+        if urlparse.urlparse(self.path)[2] == '/metrics':
+            self._reply(200, 'application/json', json.dumps(self.server.metrics.report()))
+        else:
+            self._reply(404, 'text/plain', 'Not found\n')
+    
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url[2] != '/convert':
+            self._reply(404, 'text/plain', 'Not found\n')
+            return
+        
+        query = cgi.parse_qs(url[4])
+        format = query.get('format', ['epub'])[0]
+        name = query.get('name', ['document.lyx'])[0]
+        if format not in lyx2ebook.writers:
+            self._reply(400, 'text/plain', 'Unknown format: %s\n' % format)
+            return
+        
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        
+        files = {}
+        if self.headers.get('Content-Type', '').startswith('application/zip'):
+            archive = zipfile.ZipFile(StringIO(body))
+            for info in archive.infolist():
+                # Folders are made as the files in them are written
+                if not info.filename.endswith('/'):
+                    files[info.filename] = archive.read(info)
+        else:
+            files[name] = body
+        
+        if os.path.normpath(name) not in [os.path.normpath(path) for path in files]:
+            self._reply(400, 'text/plain', 'No LyX file named %s\n' % name)
+            return
+        
+        metrics = self.server.metrics
+        metrics.begin()
+        received = time.time()
+        job = (files, name, format, self.server.cache)
+        output, error, start, end = self.server.pool.apply(convert, [job])
+        metrics.end(time.time() - received, end - start, error is not None)
+        
+        if error is None:
+            self._reply(200, content_types[format], output)
+        else:
+            self._reply(500, 'text/plain', error + '\n')
+
+class ConversionServerMixin(SocketServer.ThreadingMixIn):
+    
+    daemon_threads = True
+    
+    def start_workers(self, workers, cache=None):
+        self.pool = multiprocessing.Pool(workers, init_worker, (False,))
+        self.metrics = Metrics(workers)
+        self.cache = cache
+
+class HTTPConversionServer(ConversionServerMixin, BaseHTTPServer.HTTPServer):
+    pass
+
+class UnixConversionServer(ConversionServerMixin, SocketServer.UnixStreamServer):
+    pass
+
+def serve(port=8470, socket_path=None, workers=None, cache=None):
+    """
+    Serve conversions on localhost or a Unix socket until interrupted,
+    reusing the converted files kept in cache, an OutputCache, if given
+    """
+    
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    
+    if socket_path is None:
+        server = HTTPConversionServer(('127.0.0.1', port), ConversionHandler)
+        where = 'http://127.0.0.1:%d' % port
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixConversionServer(socket_path, ConversionHandler)
+        where = socket_path
+    
+    # Fork the workers after binding so a busy address fails fast
+    server.start_workers(workers, cache)
+    logger.info("Serving on %s with %d workers" % (where, workers))
+    
+    try:
+        server.serve_forever()
+    finally:
+        server.pool.terminate()
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    
+    return
+
+if __name__ == '__main__':
+    """
+    Serve conversions over HTTP on localhost or on a Unix socket.
+    
+    Usage: lyx2ebookd [--port N | --socket PATH] [--workers N] [--cache DIR] [--cache-size MB]
+    """
+    
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-p", "--port", type="int", default=8470,
+                      help="localhost port to listen on [default: %default]")
+    parser.add_option("-u", "--socket", default=None,
+                      help="listen on this Unix socket instead of a port")
+    parser.add_option("-w", "--workers", type="int", default=None,
+                      help="number of worker processes [default: one per core]")
+    parser.add_option("-c", "--cache", default=None, metavar="DIR",
+                      help="reuse the eBook files of unchanged documents kept in DIR")
+    parser.add_option("--cache-size", type="int", default=200, metavar="MB",
+                      help="size the cache is kept within [default: %default]")
+    options, args = parser.parse_args()
+    
+    configure_logging()
+    
+    cache = None
+    if options.cache:
+        cache = OutputCache(options.cache, options.cache_size * 1048576)
+    
+    try:
+        serve(options.port, options.socket, options.workers, cache)
+    except KeyboardInterrupt:
+        pass
@@ -8,12 +8,12 @@
     it under the terms of the GNU General Public License as published by
     the Free Software Foundation, either version 3 of the License, or
     (at your option) any later version.
-
+    
     This program is distributed in the hope that it will be useful,
     but WITHOUT ANY WARRANTY; without even the implied warranty of
     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
     GNU General Public License for more details.
-
+    
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
@@ -21,43 +21,157 @@
 
 import sys
 import logging
-import logging.config
+from optparse import OptionParser
 
 import LyxDocument
+from LyxWatcher import LyxWatcher
 import EpubDocument
+from OutputCache import OutputCache, output_file
+from ConversionMetrics import ConversionMetrics
+from LogConfig import configure_logging
 
-logging.config.fileConfig("logging.conf")
 logger = logging.getLogger('lyx2ebook')
 
-def lyx2epub(lyx_file):
+def lyx2epub(lyx_file, stream=False, keep_folder=False, jobs=1, incremental=False,
+             metrics=None, compress_level=-1, zip_threads=1, cache=None,
+             split_size=256, split_paragraphs=0):
     """
     Convert Lyx file to ePub file
+    
+    Record the stages of the conversion in metrics, a ConversionMetrics,
+    if given. The archive entries are compressed at compress_level, -1
+    for zlib's default and 0 to store them, over zip_threads threads.
+    
+    With an OutputCache, the ePub file is restored from it when the
+    document, its children and the templates have not changed.
+    
+    Chapters are split into several files once a part reaches split_size
+    KB of text or split_paragraphs paragraphs, 0 not to.
+    
+    With more than one job, the chapters are parsed as well as rendered
+    over that many processes.
     """
     
+    # The exploded folder is not cached
+    if keep_folder:
+        cache = None
+    
+    if cache is not None:
+        key = cache.key(lyx_file, 'epub', 'level=%d split=%d,%d' % (compress_level, split_size, split_paragraphs))
+        if cache.restore(key, output_file(lyx_file, 'epub')):
+            return
+    
     lyx = LyxDocument.LyxDocument()
-    lyx.parse(lyx_file)
+    lyx.metrics = metrics
+    lyx.parse_workers = jobs
+    if stream:
+        lyx.parse_stream(lyx_file)
+    else:
+        lyx.parse(lyx_file)
     
     logger.info("Title: " + lyx.title)
     logger.info("Author: " + lyx.author)
     
     epub = EpubDocument.EpubDocument()
+    epub.keep_folder = keep_folder
+    epub.chapter_workers = jobs
+    epub.incremental = incremental
+    epub.compress_level = compress_level
+    epub.compress_workers = zip_threads
+    epub.split_bytes = split_size * 1024
+    epub.split_paragraphs = split_paragraphs
     
     epub.convert_from(lyx)
     
     epub.save()
     
+    if cache is not None:
+        cache.store(key, epub.file_name)
+    
     return
 
 if __name__ == '__main__':
     """
     Convert Lyx file to epub file.
     
-    Usage: lyx2epub file.lyx
+    Usage: lyx2epub [--stream] [--keep-folder] [--jobs N] [--incremental] [--watch]
+                    [--metrics FILE] [--compress-level N] [--zip-threads N]
+                    [--cache DIR] [--cache-size MB] [--split-size KB]
+                    [--split-paragraphs N] file.lyx
     """
     
-    print 'Converting', sys.argv[1]
+    parser = OptionParser(usage="%prog [options] file.lyx")
+    parser.add_option("-s", "--stream", action="store_true", default=False,
+                      help="read the LyX file line by line in bounded memory")
+    parser.add_option("-k", "--keep-folder", action="store_true", default=False,
+                      help="also write the ePub parts to a folder, for debugging")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="number of processes parsing and rendering chapters [default: %default]")
+    parser.add_option("-i", "--incremental", action="store_true", default=False,
+                      help="only render the chapters changed since the last conversion")
+    parser.add_option("-w", "--watch", action="store_true", default=False,
+                      help="keep running and reconvert whenever the document changes")
+    parser.add_option("-m", "--metrics", default=None, metavar="FILE",
+                      help="write the time and memory of each stage as JSON to FILE, - for standard error")
+    parser.add_option("-z", "--compress-level", type="int", default=-1,
+                      help="zlib compression level, 0 to store, 1 for fast drafts [default: zlib's]")
+    parser.add_option("-t", "--zip-threads", type="int", default=1,
+                      help="number of threads compressing the archive [default: %default]")
+    parser.add_option("-c", "--cache", default=None, metavar="DIR",
+                      help="reuse the ePub files of unchanged documents kept in DIR")
+    parser.add_option("--cache-size", type="int", default=200, metavar="MB",
+                      help="size the cache is kept within [default: %default]")
+    parser.add_option("--split-size", type="int", default=256, metavar="KB",
+                      help="split chapters into files of about this much text, 0 not to [default: %default]")
+    parser.add_option("--split-paragraphs", type="int", default=0, metavar="N",
+                      help="split chapters into files of at most N paragraphs [default: not to]")
+    options, args = parser.parse_args()
+    
+    if options.compress_level < -1 or options.compress_level > 9:
+        parser.error("the compression level must be from 0 to 9")
+    
+    if options.split_size < 0 or options.split_paragraphs < 0:
+        parser.error("the split size and paragraphs cannot be negative")
+    
+    if len(args) != 1:
+        parser.error("a LyX file is required")
+    
+    if options.watch and options.metrics:
+        parser.error("--metrics cannot be used with --watch")
+    
+    configure_logging()
     
-    # Process Lyx file
-    lyx2epub(sys.argv[1])
+    cache = None
+    if options.cache:
+        cache = OutputCache(options.cache, options.cache_size * 1048576)
     
-    print 'Converted'
+    if options.watch:
+        watcher = LyxWatcher(args[0], ['epub'],
+                             lambda changed: lyx2epub(args[0], options.stream,
+                                                      options.keep_folder, options.jobs,
+                                                      options.incremental, None,
+                                                      options.compress_level,
+                                                      options.zip_threads, cache,
+                                                      options.split_size,
+                                                      options.split_paragraphs))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        print 'Converting', args[0]
+        
+        metrics = None
+        if options.metrics:
+            metrics = ConversionMetrics()
+        
+        # Process Lyx file
+        lyx2epub(args[0], options.stream, options.keep_folder, options.jobs,
+                 options.incremental, metrics, options.compress_level,
+                 options.zip_threads, cache, options.split_size,
+                 options.split_paragraphs)
+        
+        print 'Converted'
+        
+        if metrics is not None:
+            metrics.write(options.metrics)
@@ -8,12 +8,12 @@
     it under the terms of the GNU General Public License as published by
     the Free Software Foundation, either version 3 of the License, or
     (at your option) any later version.
-
+    
     This program is distributed in the hope that it will be useful,
     but WITHOUT ANY WARRANTY; without even the implied warranty of
     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
     GNU General Public License for more details.
-
+    
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
@@ -21,21 +21,37 @@
 
 import sys
 import logging
-import logging.config
+from optparse import OptionParser
 
 import LyxDocument
+from LyxWatcher import LyxWatcher
 import TextDocument
+from OutputCache import OutputCache, output_file
+from ConversionMetrics import ConversionMetrics
+from LogConfig import configure_logging
 
-logging.config.fileConfig("logging.conf")
 logger = logging.getLogger('lyx2ebook')
 
-def lyx2epub(lyx_file):
+def lyx2txt(lyx_file, stream=False, metrics=None, cache=None):
     """
-    Convert Lyx file to ePub file
+    Convert Lyx file to text file
+    
+    Record the stages of the conversion in metrics, a ConversionMetrics,
+    if given. With an OutputCache, the text file is restored from it when
+    the document and its children have not changed.
     """
     
+    if cache is not None:
+        key = cache.key(lyx_file, 'txt')
+        if cache.restore(key, output_file(lyx_file, 'txt')):
+            return
+    
     lyx = LyxDocument.LyxDocument()
-    lyx.parse(lyx_file)
+    lyx.metrics = metrics
+    if stream:
+        lyx.parse_stream(lyx_file)
+    else:
+        lyx.parse(lyx_file)
     
     logger.info("Title: " + lyx.title)
     logger.info("Author: " + lyx.author)
@@ -46,18 +62,61 @@ def lyx2epub(lyx_file):
     
     txt.save()
     
+    if cache is not None:
+        cache.store(key, txt.file_name)
+    
     return
 
 if __name__ == '__main__':
     """
     Convert Lyx file to text file.
     
-    Usage: lyx2text file.lyx
+    Usage: lyx2text [--stream] [--watch] [--metrics FILE] [--cache DIR] [--cache-size MB] file.lyx
     """
     
-    print 'Converting', sys.argv[1]
+    parser = OptionParser(usage="%prog [options] file.lyx")
+    parser.add_option("-s", "--stream", action="store_true", default=False,
+                      help="read the LyX file line by line in bounded memory")
+    parser.add_option("-w", "--watch", action="store_true", default=False,
+                      help="keep running and reconvert whenever the document changes")
+    parser.add_option("-m", "--metrics", default=None, metavar="FILE",
+                      help="write the time and memory of each stage as JSON to FILE, - for standard error")
+    parser.add_option("-c", "--cache", default=None, metavar="DIR",
+                      help="reuse the text files of unchanged documents kept in DIR")
+    parser.add_option("--cache-size", type="int", default=200, metavar="MB",
+                      help="size the cache is kept within [default: %default]")
+    options, args = parser.parse_args()
+    
+    if len(args) != 1:
+        parser.error("a LyX file is required")
+    
+    if options.watch and options.metrics:
+        parser.error("--metrics cannot be used with --watch")
+    
+    configure_logging()
     
-    # Process Lyx file
-    lyx2epub(sys.argv[1])
+    cache = None
+    if options.cache:
+        cache = OutputCache(options.cache, options.cache_size * 1048576)
     
-    print 'Converted'
+    if options.watch:
+        watcher = LyxWatcher(args[0], ['txt'],
+                             lambda changed: lyx2txt(args[0], options.stream, None, cache))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        print 'Converting', args[0]
+        
+        metrics = None
+        if options.metrics:
+            metrics = ConversionMetrics()
+        
+        # Process Lyx file
+        lyx2txt(args[0], options.stream, metrics, cache)
+        
+        print 'Converted'
+        
+        if metrics is not None:
+            metrics.write(options.metrics)
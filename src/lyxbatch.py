@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+    Convert many LyX files in parallel.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import time
+import logging
+import multiprocessing
+from optparse import OptionParser
+
+import LyxDocument
+import lyx2ebook
+from TemplateCache import templates
+from IncludeResolver import includes
+from LogConfig import configure_logging
+
+logger = logging.getLogger('lyx2ebook')
+
+def find_files(paths):
+    """
+    Return the LyX files named in paths, searching directories recursively.
+    
+    The child documents included by a LyX file found in a directory are
+    left out, as they are not books of their own.
+    """
+    
+    files = []
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for (dir_path, dir_names, file_names) in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.endswith('.lyx'):
+                        files.append(os.path.join(dir_path, file_name))
+                        found.add(files[-1])
+        else:
+            files.append(path)
+    
+    children = included(found)
+    books = [lyx_file for lyx_file in files
+             if lyx_file not in found or os.path.abspath(lyx_file) not in children]
+    if len(books) < len(files):
+        logger.info("Left out %d child documents" % (len(files) - len(books)))
+    
+    return books
+
+def included(files):
+    """
+    Return the absolute paths of the child documents the LyX files
+    include, directly or through other children
+    """
+    
+    children = set()
+    for lyx_file in sorted(files):
+        # Its children were found with the file including it
+        if os.path.abspath(lyx_file) in children:
+            continue
+        
+        try:
+            dependencies = includes.dependencies(lyx_file)
+        except Exception, e:
+            # Left for the conversion to report
+            logger.warning("Cannot read includes of %s: %s" % (lyx_file, e))
+            continue
+        
+        children.update([os.path.abspath(path) for path in dependencies])
+    
+    return children
+
+def init_worker(verbose):
+    """
+    Prepare a worker process so that every file it converts reuses the
+    same compiled grammar and templates
+    """
+    
+    configure_logging()
+    
+    if not verbose:
+        logger.setLevel(logging.ERROR)
+        logging.getLogger().setLevel(logging.ERROR)
+    
+    LyxDocument.get_parser()
+    templates.load('template')
+    
+    return
+
+def convert(job):
+    """
+    Convert one file in a worker, returning (file, error, seconds)
+    """
+    
+    lyx_file, formats, stream = job
+    
+    start = time.time()
+    try:
+        lyx2ebook.lyx2ebook(lyx_file, formats, stream)
+        error = None
+    except Exception, e:
+        logger.exception("Failed to convert " + lyx_file)
+        error = '%s: %s' % (e.__class__.__name__, str(e).split('\n')[0])
+    
+    return (lyx_file, error, time.time() - start)
+
+def batch(files, formats=None, processes=None, stream=False, verbose=False):
+    """
+    Convert the files over a pool of worker processes, printing the
+    status of each file as it completes and a summary at the end.
+    
+    Return the number of files that failed.
+    """
+    
+    if formats is None:
+        formats = ['epub']
+    
+    start = time.time()
+    pool = multiprocessing.Pool(processes, init_worker, (verbose,))
+    
+    jobs = [(lyx_file, formats, stream) for lyx_file in files]
+    
+    failed = 0
+    busy = 0.0
+    try:
+        for lyx_file, error, seconds in pool.imap_unordered(convert, jobs):
+            busy += seconds
+            if error is None:
+                print '%-6s %8.3fs  %s' % ('OK', seconds, lyx_file)
+            else:
+                failed += 1
+                print '%-6s %8.3fs  %s (%s)' % ('FAILED', seconds, lyx_file, error)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+    
+    elapsed = time.time() - start
+    print
+    print 'Converted %d of %d files to %s in %.3fs' % (len(files) - failed, len(files), ', '.join(formats), elapsed)
+    if files:
+        print 'Average %.3fs per file, %.3fs of conversion time in total' % (busy / len(files), busy)
+    
+    return failed
+
+if __name__ == '__main__':
+    """
+    Convert LyX files, or every LyX file under directories, in parallel.
+    
+    Usage: lyxbatch [options] file.lyx|directory ...
+    """
+    
+    parser = OptionParser(usage="%prog [options] file.lyx|directory ...")
+    parser.add_option("-f", "--format", default="epub",
+                      help="comma separated output formats from epub, rtf "
+                           "and txt [default: %default]")
+    parser.add_option("-j", "--jobs", type="int", default=None,
+                      help="number of worker processes [default: one per core]")
+    parser.add_option("-s", "--stream", action="store_true", default=False,
+                      help="read the LyX files line by line in bounded memory")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help="keep the per-file conversion log")
+    options, args = parser.parse_args()
+    
+    if not args:
+        parser.error("at least one LyX file or directory is required")
+    
+    try:
+        formats = lyx2ebook.parse_formats(options.format)
+    except ValueError, e:
+        parser.error(str(e))
+    
+    configure_logging()
+    
+    failed = batch(find_files(args), formats, options.jobs,
+                   options.stream, options.verbose)
+    
+    sys.exit(failed and 1 or 0)
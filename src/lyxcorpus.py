@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+    Generate synthetic LyX documents for benchmarking.
+    
+    This file is part of lyx2ebook.
+    
+    lyx2ebook is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import random
+from optparse import OptionParser
+
+words = ("lorem ipsum dolor sit amet consectetur adipiscing elit vestibulum vitae "
+         "nunc nec est molestie eleifend eget integer lobortis urna imperdiet "
+         "elementum auctor ante aliquet quisque pharetra enim laoreet quam "
+         "hendrerit cras mauris volutpat leo fusce quis erat dui pretium").split()
+
+header = """#LyX 1.6.5 created this file. For more info see http://www.lyx.org/
+\\lyxformat 345
+\\begin_document
+\\begin_header
+\\textclass book
+\\use_default_options true
+\\language english
+\\inputencoding auto
+\\paperfontsize default
+\\papersize default
+\\paragraph_separation indent
+\\quotes_language english
+\\end_header
+
+\\begin_body
+
+"""
+
+footer = """\\end_body
+\\end_document
+"""
+
+# Character-level insets the grammar reads inside a paragraph
+insets = [
+    "\\begin_inset Quotes eld\n\\end_inset\n",
+    "\\begin_inset Quotes erd\n\\end_inset\n",
+    "\\begin_inset space ~\n\\end_inset\n",
+]
+
+def layout(name, text):
+    return "\\begin_layout %s\n%s\n\\end_layout\n\n" % (name, text)
+
+def include(name):
+    return ("\\begin_layout Standard\n\\begin_inset CommandInset include\n"
+            "LatexCommand include\nfilename \"%s\"\n\n\\end_inset\n\n\n\\end_layout\n\n" % name)
+
+def paragraph(rand, length, inset_density):
+    """
+    Return a Standard layout of about length words, one sentence per line
+    as LyX writes them, with an inset after each word with probability
+    inset_density
+    """
+    
+    lines = []
+    sentence = []
+    for i in range(length):
+        sentence.append(rand.choice(words))
+        if len(sentence) >= 12 or i == length - 1:
+            text = " ".join(sentence).capitalize() + "."
+            lines.append(lines and " " + text or text)
+            sentence = []
+        if rand.random() < inset_density:
+            if sentence:
+                lines.append((lines and " " or "") + " ".join(sentence))
+                sentence = []
+            lines.append(rand.choice(insets).rstrip("\n"))
+    
+    return layout("Standard", "\n".join(lines))
+
+def write_document(path, body):
+    f = open(path, "w")
+    f.write(header + body + footer)
+    f.close()
+    
+    return
+
+def write_corpus(folder, chapters=10, paragraphs=20, length=60, depth=1,
+                 inset_density=0.0, seed=0):
+    """
+    Write a master LyX document to folder and return its path.
+    
+    The book has chapters chapters of paragraphs paragraphs of about
+    length words each. With depth 0 every chapter is in the master; with
+    depth n each chapter is a child document whose paragraphs are spread
+    over a chain of n nested children.
+    """
+    
+    rand = random.Random(seed)
+    
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    
+    body = layout("Title", "Synthetic Book") + layout("Author", "lyxcorpus")
+    
+    for c in range(chapters):
+        texts = [paragraph(rand, length, inset_density) for p in range(paragraphs)]
+        title = layout("Chapter", "Chapter %d" % (c + 1))
+        
+        if depth == 0:
+            body += title + "".join(texts)
+            continue
+        
+        # Each level of the chain keeps its share of the paragraphs and
+        # includes the next level, from the deepest child upwards
+        share = (paragraphs + depth - 1) // depth
+        child = None
+        for level in range(depth - 1, -1, -1):
+            part = (level == 0 and title or "") + "".join(texts[level * share:(level + 1) * share])
+            if child is not None:
+                part += include(child)
+            child = "chapter%d-%d.lyx" % (c + 1, level)
+            write_document(os.path.join(folder, child), part)
+        
+        body += include(child)
+    
+    master = os.path.join(folder, "book.lyx")
+    write_document(master, body)
+    
+    return master
+
+if __name__ == '__main__':
+    """
+    Write a synthetic LyX book.
+    
+    Usage: lyxcorpus [options] folder
+    """
+    
+    parser = OptionParser(usage="%prog [options] folder")
+    parser.add_option("-c", "--chapters", type="int", default=10,
+                      help="number of chapters [default: %default]")
+    parser.add_option("-p", "--paragraphs", type="int", default=20,
+                      help="paragraphs per chapter [default: %default]")
+    parser.add_option("-l", "--length", type="int", default=60,
+                      help="words per paragraph [default: %default]")
+    parser.add_option("-d", "--depth", type="int", default=1,
+                      help="include depth, 0 for a single file [default: %default]")
+    parser.add_option("-i", "--insets", type="float", default=0.0,
+                      help="probability of an inset after each word [default: %default]")
+    parser.add_option("--seed", type="int", default=0,
+                      help="random seed [default: %default]")
+    options, args = parser.parse_args()
+    
+    if len(args) != 1:
+        parser.error("an output folder is required")
+    
+    print write_corpus(args[0], options.chapters, options.paragraphs, options.length,
+                       options.depth, options.insets, options.seed)